@@ -1,20 +1,36 @@
+import threading
 import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor
 from tkinter import filedialog, messagebox
 from tkinter.ttk import Progressbar
-from tkinter import StringVar
+from tkinter import BooleanVar, IntVar, StringVar
 from controller import FileOrganizerController
+from instrumentation import setup_logging
+from run_stats import RunStats
 
 class AppGUI:
+    poll_interval_ms = 100
+
     def __init__(self, root):
         self.root = root
         self.root.title("File Organizer")
-        self.root.geometry("600x400")
+        self.root.geometry("600x700")
         self.root.config(bg='pink')
 
         self.controller = FileOrganizerController()
         self.source_folder_var = StringVar()
+        self.workers_var = IntVar(value=self.controller.workers)
+        self.dry_run_var = BooleanVar(value=False)
+        self.status_var = StringVar(value="")
+
+        # Runs go to a background thread, the Tk main thread only polls their RunStats
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.running = None
+        self.run_stats = None
+        self.cancel_event = None
 
         self.setup_ui()
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
 
     def setup_ui(self):
         """Set up the user interface."""
@@ -28,12 +44,33 @@ class AppGUI:
                                      bg='pink')
         self.folder_label.pack(pady=10)
 
+        # Worker Count
+        tk.Label(self.root, text="Workers", bg='pink').pack()
+        tk.Spinbox(self.root, from_=1, to=64, width=5,
+                   textvariable=self.workers_var,
+                   command=self.set_workers).pack(pady=5)
+
+        # Dry Run
+        tk.Checkbutton(self.root, text="Dry run (preview only)",
+                       variable=self.dry_run_var,
+                       command=self.set_dry_run,
+                       bg='pink').pack(pady=5)
+
         # Progress Bar
         self.progress_bar = Progressbar(self.root, orient="horizontal",
                                         length=500, mode="determinate",
                                         )
         self.progress_bar.pack(pady=10)
 
+        # Stage, files per second and ETA
+        tk.Label(self.root, textvariable=self.status_var, bg='pink').pack()
+
+        self.cancel_button = tk.Button(self.root, text="Cancel",
+                                       command=self.cancel,
+                                       state=tk.DISABLED,
+                                       bg='pink')
+        self.cancel_button.pack(pady=5)
+
         # Action Buttons
         self.organize_button = tk.Button(self.root, text="Start Organizing",
                                          command=self.start_organizing,
@@ -45,6 +82,11 @@ class AppGUI:
                                           bg='pink')
         self.duplicate_button.pack(pady=10)
 
+        self.similar_button = tk.Button(self.root, text="Find Similar Photos",
+                                        command=self.find_similar,
+                                        bg='pink')
+        self.similar_button.pack(pady=10)
+
         self.correct_button = tk.Button(self.root, text="Correct Characters",
                                         command=self.correct_characters,
                                         bg='pink')
@@ -55,6 +97,12 @@ class AppGUI:
                                              bg='pink')
         self.sort_no_exif_button.pack(pady=10)
 
+        # Runs until Cancel is pressed
+        self.watch_button = tk.Button(self.root, text="Watch Folder",
+                                      command=self.watch_folder,
+                                      bg='pink')
+        self.watch_button.pack(pady=10)
+
     def select_source_folder(self):
         folder_selected = filedialog.askdirectory()
         if folder_selected:
@@ -62,23 +110,108 @@ class AppGUI:
             self.folder_label.config(text=f"Selected Folder: {folder_selected}")
             self.controller.set_source_folder(folder_selected)
 
+    def set_workers(self):
+        try:
+            self.controller.set_workers(self.workers_var.get())
+        except (tk.TclError, ValueError):
+            self.workers_var.set(self.controller.workers)
+
+    def set_dry_run(self):
+        self.controller.set_dry_run(self.dry_run_var.get())
+
     def start_organizing(self):
-        result = self.controller.organize_files()
-        messagebox.showinfo("Completed", result)
+        self.run_in_background(self.controller.organize_files)
 
     def find_duplicates(self):
-        result = self.controller.find_duplicates()
-        messagebox.showinfo("Completed", result)
+        self.run_in_background(self.controller.find_duplicates)
+
+    def find_similar(self):
+        self.run_in_background(self.controller.find_similar)
 
     def correct_characters(self):
-        result = self.controller.correct_file_names()
-        messagebox.showinfo("Completed", result)
+        self.run_in_background(self.controller.correct_file_names)
 
     def sort_no_exif(self):
-        result = self.controller.sort_no_exif()
-        messagebox.showinfo("Completed", result)
+        self.run_in_background(self.controller.sort_no_exif)
+
+    def watch_folder(self):
+        self.run_in_background(self.controller.watch)
+
+    ### Background runs ###
+
+    def action_buttons(self):
+        return [self.organize_button, self.duplicate_button, self.similar_button,
+                self.correct_button, self.sort_no_exif_button, self.watch_button]
+
+    def run_in_background(self, action):
+        """Start a controller action on the worker thread and poll its progress."""
+        if self.running is not None:
+            return
+        self.set_workers()
+        self.set_dry_run()
+
+        self.run_stats = RunStats()
+        self.cancel_event = threading.Event()
+        self.running = self.executor.submit(action, self.run_stats, self.cancel_event)
+
+        for button in self.action_buttons():
+            button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.progress_bar.config(value=0)
+        self.root.after(self.poll_interval_ms, self.poll_progress)
+
+    def poll_progress(self):
+        """Runs on the Tk main thread: show the live RunStats, finish when the run is done."""
+        stage, done, total, rate, eta = self.run_stats.progress()
+        if total:
+            self.progress_bar.config(mode="determinate", maximum=total, value=min(done, total))
+        else:
+            # The streaming scan doesn't know the total yet
+            self.progress_bar.config(mode="indeterminate")
+            self.progress_bar.step()
+
+        status = f"{stage or 'starting'}: {done}" + (f"/{total}" if total else "") + " files"
+        status += f", {rate:.1f} files/s"
+        if eta is not None:
+            status += f", ETA {eta:.0f}s"
+        self.status_var.set(status)
+
+        if self.running.done():
+            self.finish_background_run()
+        else:
+            self.root.after(self.poll_interval_ms, self.poll_progress)
+
+    def finish_background_run(self):
+        future = self.running
+        self.running = None
+        for button in self.action_buttons():
+            button.config(state=tk.NORMAL)
+        self.cancel_button.config(state=tk.DISABLED)
+
+        try:
+            result = future.result()
+        except Exception as e:
+            messagebox.showerror("Failed", str(e))
+            return
+        self.status_var.set(f"Done in {result.elapsed or 0:.1f}s")
+        if result.error:
+            messagebox.showerror("Failed", str(result))
+            return
+        messagebox.showinfo("Completed", str(result))
+
+    def cancel(self):
+        """Ask the running job to stop between files."""
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+            self.status_var.set("Cancelling...")
+
+    def close(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
+        self.root.destroy()
 
 def main():
+    setup_logging()
     root = tk.Tk()
     app = AppGUI(root)
     root.mainloop()
@@ -0,0 +1,292 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from instrumentation import LOG_LEVELS, setup_logging
+from run_stats import RunStats
+
+"""
+This file is used for:
+- Generating a synthetic photo corpus in a temp folder
+- Timing the pipeline stages on it: scan, exif, hash and a full organize run
+- Writing a JSON result that can be compared with a run on another commit
+
+Usage:
+    python benchmark.py --files 5000 --workers 4 --output before.json
+    python benchmark.py --files 5000 --workers 4 --compare before.json
+
+The corpus is built from a fixed seed, so the same arguments give the same
+files on every commit.
+"""
+
+
+class CorpusGenerator:
+    def __init__(self, folder, seed=42):
+        self.folder = folder
+        self.rng = random.Random(seed)
+
+    def generate(self, files=1000, exif_ratio=0.7, duplicate_ratio=0.1,
+                 min_size=20 * 1024, max_size=4 * 1024 * 1024, depth=0):
+        """
+        Write files to the folder and return the amount of bytes written.
+        Sizes follow a log-uniform distribution between min_size and max_size,
+        depth > 0 spreads the files over nested subfolders.
+        """
+        folders = [self.folder]
+        for level in range(depth):
+            folders.append(os.path.join(folders[-1], f"level{level}"))
+        for folder in folders:
+            os.makedirs(folder, exist_ok=True)
+
+        written = []
+        total_bytes = 0
+        for number in range(files):
+            folder = self.rng.choice(folders)
+            if written and self.rng.random() < duplicate_ratio:
+                # Byte-identical copy of an earlier file under a new name
+                source = self.rng.choice(written)
+                extension = os.path.splitext(source)[1]
+                file_path = os.path.join(folder, f"copy_{number:07d}{extension}")
+                shutil.copyfile(source, file_path)
+            else:
+                size = int(min_size * (max_size / min_size) ** self.rng.random())
+                if self.rng.random() < exif_ratio:
+                    file_path = os.path.join(folder, f"IMG_{number:07d}.jpg")
+                    data = self.jpeg(size, self.random_date())
+                else:
+                    file_path = os.path.join(folder, f"FILE_{number:07d}.jpg")
+                    data = self.jpeg(size, None)
+                with open(file_path, "wb") as file:
+                    file.write(data)
+                written.append(file_path)
+            total_bytes += os.path.getsize(file_path)
+        return total_bytes
+
+    def random_date(self):
+        year = self.rng.randint(2000, 2024)
+        month = self.rng.randint(1, 12)
+        day = self.rng.randint(1, 28)
+        return f"{year:04d}:{month:02d}:{day:02d} 12:00:00"
+
+    def jpeg(self, size, date_taken):
+        """A JPEG shell: SOI, optional APP1 Exif with the date tags, random scan data, EOI."""
+        data = b"\xff\xd8"
+        if date_taken is not None:
+            tiff = self.tiff(date_taken.encode("ascii") + b"\x00")
+            data += b"\xff\xe1" + struct.pack(">H", len(tiff) + 8) + b"Exif\x00\x00" + tiff
+        data += b"\xff\xda" + struct.pack(">H", 2)
+        padding = max(0, size - len(data) - 2)
+        data += self.rng.randbytes(padding) + b"\xff\xd9"
+        return data
+
+    @staticmethod
+    def tiff(date_taken):
+        """Little-endian TIFF with DateTime in IFD0 and DateTimeOriginal in the Exif IFD."""
+        ifd0_offset = 8
+        exif_ifd_offset = ifd0_offset + 2 + 2 * 12 + 4
+        data_offset = exif_ifd_offset + 2 + 12 + 4
+        header = b"II" + struct.pack("<HI", 42, ifd0_offset)
+        ifd0 = (struct.pack("<H", 2)
+                + struct.pack("<HHII", 306, 2, len(date_taken), data_offset)
+                + struct.pack("<HHII", 0x8769, 4, 1, exif_ifd_offset)
+                + struct.pack("<I", 0))
+        exif_ifd = (struct.pack("<H", 1)
+                    + struct.pack("<HHII", 36867, 2, len(date_taken), data_offset)
+                    + struct.pack("<I", 0))
+        return header + ifd0 + exif_ifd + date_taken
+
+
+class Benchmark:
+    def __init__(self, workers=1, hash_algorithm=None, memory_budget=None):
+        self.workers = workers
+        self.hash_algorithm = hash_algorithm
+        self.memory_budget = memory_budget
+        self.results = {}
+
+    def measure(self, stage, work, amounts=None):
+        """
+        Time work(). amounts(result) returns the (files, bytes) the stage handled,
+        by default the length of the result and no bytes.
+        """
+        start = time.perf_counter()
+        result = work()
+        seconds = time.perf_counter() - start
+        files, stage_bytes = amounts(result) if amounts is not None else (len(result), 0)
+        self.results[stage] = {
+            "seconds": seconds,
+            "files": files,
+            "bytes": stage_bytes,
+            "files_per_second": files / seconds if seconds > 0 else 0.0,
+            "mb_per_second": stage_bytes / (1024 * 1024) / seconds if seconds > 0 else 0.0,
+            # ru_maxrss never goes down: the peak of the whole process up to the end of this stage
+            "process_peak_rss": RunStats.peak_memory(),
+        }
+        print(f"{stage:>10}: {seconds:8.3f}s {self.results[stage]['files_per_second']:10.1f} files/s "
+              f"{self.results[stage]['mb_per_second']:8.1f} MB/s", file=sys.stderr)
+        return result
+
+    def run(self, folder):
+        from bounded_duplicate_finder import BoundedDuplicateFinder
+        from duplicate_finder import DuplicateFinder
+        from file_organizer import FileOrganizer
+        from program_utils import ProgramUtils
+
+        entries = self.measure("scan", lambda: list(ProgramUtils.scan_files(folder, recursive=True)))
+        paths = [entry.path for entry in entries]
+
+        organizer = FileOrganizer(folder, use_index=False, workers=self.workers)
+        self.measure("exif", lambda: organizer.collect_exif_dates(paths))
+
+        if self.memory_budget:
+            finder = BoundedDuplicateFinder(workers=self.workers, algorithm=self.hash_algorithm,
+                                            memory_budget=self.memory_budget)
+        else:
+            finder = DuplicateFinder(workers=self.workers, algorithm=self.hash_algorithm)
+        # MB/s of the bytes the staged hashing actually read, not of the corpus
+        self.measure("hash", lambda: finder.find_duplicates(paths),
+                     lambda result: (len(paths), finder.run_stats.counters["bytes_read"]))
+
+        # Moves the files, so this runs last. It only scans the top folder: with --depth
+        # the files in subfolders are not part of this stage.
+        organizer = FileOrganizer(folder, use_index=False, workers=self.workers)
+        self.measure("organize", lambda: organizer.organize_files_by_exif(ProgramUtils.scan_files(folder)),
+                     lambda stats: (stats.counters["files_found"], 0))
+        return self.results
+
+
+def benchmark_date_extraction(count, seed=42):
+    """Micro-benchmark: RegexUtils.regex_date_filter against the single-pass extract_dates."""
+    from regex_utils import RegexUtils
+
+    rng = random.Random(seed)
+    layouts = [
+        "IMG-{y}{m}{d}-WA{n:04d}.jpg",
+        "VID_{y}{m}{d}_{n:06d}.mp4",
+        "Screenshot_{y}-{m}-{d}-12-00-00.png",
+        "scan {d}-{m}-{y}.jpg",
+        "holiday {m}-{y} {n}.jpg",
+        "DSC{n:05d}.JPG",
+    ]
+    names = []
+    for number in range(count):
+        layout = rng.choice(layouts)
+        names.append(layout.format(y=rng.randint(2000, 2024), m=f"{rng.randint(1, 12):02d}",
+                                   d=f"{rng.randint(1, 28):02d}", n=number))
+
+    def split_raw_date(raw):
+        """What callers of regex_date_filter had to do: re-split the raw match by hand."""
+        if raw is None:
+            return None
+        digits = raw.replace("-", "")
+        if len(digits) == 8:
+            if digits[:2] in ("19", "20") and RegexUtils.date_patterns[0].fullmatch(raw):
+                return int(digits[:4]), int(digits[4:6]), int(digits[6:])
+            return int(digits[4:]), int(digits[2:4]), int(digits[:2])
+        if digits[:2] in ("19", "20") and RegexUtils.date_patterns[2].fullmatch(raw):
+            return int(digits[:4]), int(digits[4:]), None
+        return int(digits[2:]), int(digits[:2]), None
+
+    results = {}
+    for name, work in [("regex_date_filter", lambda: [RegexUtils.regex_date_filter(n) for n in names]),
+                       ("regex_date_filter+split",
+                        lambda: [split_raw_date(RegexUtils.regex_date_filter(n)) for n in names]),
+                       ("extract_dates", lambda: RegexUtils.extract_dates(names))]:
+        start = time.perf_counter()
+        work()
+        seconds = time.perf_counter() - start
+        results[name] = {"seconds": seconds, "names_per_second": count / seconds if seconds > 0 else 0.0}
+        print(f"{name:>24}: {seconds:8.3f}s {results[name]['names_per_second']:12.1f} names/s", file=sys.stderr)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(current, previous):
+    """Print the change per stage against an earlier result file."""
+    print(f"Compared with {previous.get('commit')}:", file=sys.stderr)
+    for stage, result in current["stages"].items():
+        before = previous["stages"].get(stage)
+        if not before or not before["seconds"]:
+            continue
+        change = (result["seconds"] - before["seconds"]) / before["seconds"] * 100
+        print(f"{stage:>10}: {before['seconds']:8.3f}s -> {result['seconds']:8.3f}s ({change:+.1f}%)",
+              file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the SortFiles pipeline on a synthetic corpus.")
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--exif-ratio", type=float, default=0.7)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.1)
+    parser.add_argument("--min-size", type=int, default=20 * 1024)
+    parser.add_argument("--max-size", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--depth", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--hash", dest="hash_algorithm", default=None,
+                        help="hash algorithm for the hash stage (default: blake2b)")
+    parser.add_argument("--memory-budget", type=float, default=None,
+                        help="MiB: run the hash stage with the memory-bounded finder")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--log-level", default="warning", choices=list(LOG_LEVELS),
+                        help="log level of the organizer while it is timed (default: warning)")
+    parser.add_argument("--date-names", type=int, default=0,
+                        help="only run the filename date extraction micro-benchmark on this many names")
+    parser.add_argument("--output", help="write the JSON result to this file")
+    parser.add_argument("--compare", help="an earlier JSON result to compare with")
+    args = parser.parse_args(argv)
+
+    if args.date_names:
+        result = {"commit": git_commit(), "python": platform.python_version(),
+                  "date_extraction": benchmark_date_extraction(args.date_names, args.seed)}
+        print(json.dumps(result, indent=2))
+        return 0
+
+    folder = tempfile.mkdtemp(prefix="sortfiles_bench_")
+    try:
+        total_bytes = CorpusGenerator(folder, args.seed).generate(
+            args.files, args.exif_ratio, args.duplicate_ratio, args.min_size, args.max_size, args.depth)
+
+        # Keep the organizer's own output (its log and run report) off stdout, per-file messages stay off entirely
+        setup_logging(args.log_level, sys.stderr)
+        memory_budget = int(args.memory_budget * 2 ** 20) if args.memory_budget else None
+        with contextlib.redirect_stdout(sys.stderr):
+            stages = Benchmark(args.workers, args.hash_algorithm, memory_budget).run(folder)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    result = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "corpus_bytes": total_bytes,
+        "stages": stages,
+    }
+    if args.compare:
+        with open(args.compare) as file:
+            compare(result, json.load(file))
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text)
+    print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+import os
+import shutil
+import struct
+import tempfile
+
+from duplicate_finder import DuplicateFinder
+from instrumentation import log
+
+"""
+This file is used for:
+- Finding duplicates in trees with millions of files within a memory budget
+
+Differences with DuplicateFinder (the groups it finds are the same):
+- A file is kept as (id, directory id, name, mtime_ns, inode, device) instead of a path
+  string and a full os.stat_result, every directory prefix is stored once
+- Files are bucketed by size in memory until the estimated size of the buckets
+  passes memory_budget, then all buckets are spilled to partition files on disk
+  (by size, so a size bucket never spans two partitions) and the rest of the scan
+  is written there directly
+- Stage 2 and 3 run one partition at a time, hashes are grouped by 16-byte
+  binary digests instead of hex strings
+
+The directory prefixes stay in memory, a partition is read back as a whole.
+Every input file must be unique, like the entries of ProgramUtils.scan_files
+(FileOrganizerController.scan_roots scans overlapping roots once).
+"""
+
+
+class FileStat:
+    """The part of os.stat_result the finder and the index use."""
+    __slots__ = ("st_size", "st_mtime_ns", "st_ino", "st_dev")
+
+    def __init__(self, size, mtime_ns, inode, device):
+        self.st_size = size
+        self.st_mtime_ns = mtime_ns
+        self.st_ino = inode
+        self.st_dev = device
+
+
+class SizeBuckets:
+    """{size: [record]} that moves to partition files on disk once it outgrows the memory budget."""
+    partitions = 64
+    # size, file id, directory id, mtime_ns, inode, device, length of the encoded name
+    record_header = struct.Struct("<qIIqQQH")
+    # Rough CPython sizes: a record tuple with its ints and name, a new dict key with its list
+    record_bytes = 200
+    bucket_bytes = 150
+
+    def __init__(self, memory_budget, spill_folder=None):
+        self.memory_budget = memory_budget
+        self.spill_folder = spill_folder
+        self.buckets = {}
+        self.estimated_bytes = 0
+        self.folder = None
+        self.files = None
+        self.spilled = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, size, record):
+        """record is (file id, directory id, name, mtime_ns, inode, device)."""
+        if self.files is not None:
+            self.write(size, record)
+            return
+        bucket = self.buckets.get(size)
+        if bucket is None:
+            bucket = self.buckets[size] = []
+            self.estimated_bytes += self.bucket_bytes
+        bucket.append(record)
+        self.estimated_bytes += self.record_bytes + len(record[2])
+        if self.estimated_bytes > self.memory_budget:
+            self.spill()
+
+    def spill(self):
+        self.folder = tempfile.mkdtemp(prefix="sortfiles_spill_", dir=self.spill_folder)
+        self.files = [open(os.path.join(self.folder, f"{number}.bin"), "w+b")
+                      for number in range(self.partitions)]
+        log.info("Memory budget of %.0f MiB reached, size buckets spill to %s",
+                 self.memory_budget / 2 ** 20, self.folder)
+        for size, bucket in self.buckets.items():
+            for record in bucket:
+                self.write(size, record)
+        self.buckets = {}
+        self.estimated_bytes = 0
+
+    def write(self, size, record):
+        file_id, directory_id, name, mtime_ns, inode, device = record
+        encoded = os.fsencode(name)
+        self.files[size % self.partitions].write(
+            self.record_header.pack(size, file_id, directory_id, mtime_ns, inode, device, len(encoded)) + encoded)
+        self.spilled += 1
+
+    def shared_sizes(self):
+        """Yield {size: [record]} of the sizes with more than one file: once, or once per partition after a spill."""
+        if self.files is None:
+            yield {size: bucket for size, bucket in self.buckets.items() if len(bucket) > 1}
+            return
+        header = self.record_header
+        for file in self.files:
+            file.seek(0)
+            data = file.read()
+            # Free the disk space of a partition once it is in memory
+            file.truncate(0)
+            buckets = {}
+            offset = 0
+            while offset < len(data):
+                size, file_id, directory_id, mtime_ns, inode, device, length = header.unpack_from(data, offset)
+                offset += header.size
+                name = os.fsdecode(data[offset:offset + length])
+                offset += length
+                buckets.setdefault(size, []).append((file_id, directory_id, name, mtime_ns, inode, device))
+            del data
+            yield {size: bucket for size, bucket in buckets.items() if len(bucket) > 1}
+
+    def close(self):
+        if self.files is not None:
+            for file in self.files:
+                file.close()
+            self.files = None
+        if self.folder is not None:
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self.folder = None
+
+
+class BoundedDuplicateFinder(DuplicateFinder):
+    default_memory_budget = 256 * 1024 * 1024
+
+    def __init__(self, index=None, workers=1, run_stats=None, cancel_event=None, algorithm=None,
+                 memory_budget=None, spill_folder=None, device_workers=None):
+        """
+        memory_budget: bytes the size buckets may take before they spill to disk
+        spill_folder: where the partition files go, the system temp folder by default
+        """
+        super().__init__(index, workers, run_stats, cancel_event, algorithm, device_workers)
+        self.memory_budget = memory_budget or self.default_memory_budget
+        self.spill_folder = spill_folder
+        self.directories = []
+
+    def group_duplicates(self, files):
+        """The same groups as DuplicateFinder.group_duplicates, in the same order."""
+        self.total_bytes = 0
+        self.directories = []
+
+        groups = []
+        with SizeBuckets(self.memory_budget, self.spill_folder) as buckets:
+            with self.run_stats.stage("scan"):
+                self.bucket_by_size(files, buckets)
+            if buckets.spilled:
+                self.run_stats.add("spilled_files", buckets.spilled)
+
+            for shared_sizes in buckets.shared_sizes():
+                self.check_cancelled()
+                self.file_stats = {}
+                self.order = {}
+                for size, records in shared_sizes.items():
+                    for file_id, directory_id, name, mtime_ns, inode, device in records:
+                        file_name = self.directories[directory_id] + name
+                        self.file_stats[file_name] = FileStat(size, mtime_ns, inode, device)
+                        self.order[file_name] = file_id
+                del shared_sizes
+                for group in self.group_candidates(list(self.file_stats)):
+                    group.sort(key=self.order.get)
+                    groups.append((self.order[group[0]], group))
+                self.file_stats = {}
+                self.order = {}
+
+        groups.sort(key=lambda item: item[0])
+        return [group for _, group in groups]
+
+    def bucket_by_size(self, files, buckets):
+        """Stage 1: stat every file once and bucket it by size, a path is stored as a directory id and a name."""
+        directory_ids = {}
+        for file_id, file in enumerate(files):
+            self.check_cancelled()
+            if isinstance(file, os.DirEntry):
+                file_name, name = file.path, file.name
+            else:
+                file_name, name = file, os.path.basename(file)
+            try:
+                with self.run_stats.span("stat"):
+                    stat = file.stat() if isinstance(file, os.DirEntry) else os.stat(file_name)
+            except OSError as e:
+                log.warning("Error reading size for %s: %s", file_name, e)
+                continue
+            # Slicing instead of os.path.split keeps prefix + name equal to the original path
+            directory = file_name[:len(file_name) - len(name)]
+            directory_id = directory_ids.get(directory)
+            if directory_id is None:
+                directory_id = directory_ids[directory] = len(self.directories)
+                self.directories.append(directory)
+
+            size = stat.st_size
+            buckets.add(size, (file_id, directory_id, name, stat.st_mtime_ns, stat.st_ino, stat.st_dev))
+            self.total_bytes += size
+            self.run_stats.add("files_found")
+            self.run_stats.advance()
+            self.run_stats.add("total_bytes", size)
+
+    @staticmethod
+    def digest_key(file_hash):
+        """16 bytes of the digest instead of its hex string."""
+        return bytes.fromhex(file_hash)[:16]
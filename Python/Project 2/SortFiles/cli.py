@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import sys
+
+from file_hasher import FileHasher
+from instrumentation import LOG_LEVELS, Profiler, Tracer, setup_logging
+from link_deduper import LinkDeduper
+
+"""
+This file is used for:
+- Running the organizer without the GUI (scheduled jobs, headless servers, benchmarks)
+
+Usage:
+    python cli.py organize /path/to/folder --workers 8 --json
+    python cli.py find-duplicates /path/to/folder --dry-run
+    python cli.py find-duplicates /path/to/folder --hash md5
+    python cli.py find-duplicates /path/to/folder --link auto
+    python cli.py find-duplicates /mnt/disk1/photos /mnt/disk2/photos /mnt/disk3/backup
+    python cli.py find-duplicates /path/to/share --memory-budget 512
+    python cli.py find-similar /path/to/folder --threshold 4 --dry-run
+    python cli.py sort-no-exif /path/to/folder --no-index
+    python cli.py correct-names /path/to/folder
+    python cli.py resume /path/to/folder
+    python cli.py undo /path/to/folder --dry-run
+    python cli.py watch /path/to/inbox --debounce 5
+    python cli.py organize /path/to/folder --log-level warning --trace run.trace.json
+    python cli.py find-duplicates /path/to/folder --workers 1 --profile cpu --profile-out run.prof
+
+Exits with 1 when the run stopped on an error, the JSON report has it in "error".
+
+The controller (and through it PIL) is only imported once the arguments are
+parsed, tkinter is never imported. file_hasher, instrumentation and link_deduper
+only need the stdlib.
+"""
+
+ACTIONS = {
+    "organize": "organize_files",
+    "find-duplicates": "find_duplicates",
+    "find-similar": "find_similar",
+    "sort-no-exif": "sort_no_exif",
+    "correct-names": "correct_file_names",
+    "resume": "resume",
+    "undo": "undo",
+    "watch": "watch",
+}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="sortfiles", description="Organize photos and videos by date.")
+    parser.add_argument("action", choices=sorted(ACTIONS), help="what to do with the folder")
+    parser.add_argument("folders", nargs="+", metavar="folder",
+                        help="the source folder, find-duplicates also takes more roots (e.g. other disks). "
+                             "The moves in all roots are journaled in the first folder, resume or undo them there")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker threads/processes for hashing and EXIF reading (default: CPU count)")
+    recursion = parser.add_mutually_exclusive_group()
+    recursion.add_argument("--recursive", dest="recursive", action="store_true", default=None,
+                           help="include subfolders (default for find-duplicates and find-similar)")
+    recursion.add_argument("--no-recursive", dest="recursive", action="store_false",
+                           help="only the folder itself (default for the other actions)")
+    parser.add_argument("--dry-run", action="store_true", help="print the planned moves without executing them")
+    index = parser.add_mutually_exclusive_group()
+    index.add_argument("--index", dest="index_path", default=None,
+                       help="location of the index file (default: inside the source folder)")
+    index.add_argument("--no-index", action="store_true", help="don't read or write the index")
+    parser.add_argument("--hash", dest="hash_algorithm", default=None,
+                        choices=FileHasher.available_algorithms(),
+                        help="hash algorithm for duplicate detection (default: blake2b, md5 matches older reports)")
+    parser.add_argument("--no-journal", action="store_true",
+                        help="don't record the moves, the run can't be resumed or undone")
+    parser.add_argument("--link", dest="link_mode", default=None, choices=LinkDeduper.modes,
+                        help="find-duplicates: replace duplicates with hardlinks/reflinks instead of moving them "
+                             "(recorded in the journal, but undo does not reverse them)")
+    parser.add_argument("--device-workers", type=int, default=None,
+                        help="find-duplicates: threads per disk, each disk reads in inode order "
+                             "(default: 1 with several roots, one shared pool otherwise)")
+    parser.add_argument("--memory-budget", type=float, default=None,
+                        help="find-duplicates: MiB the file lists may use before they spill to disk "
+                             "(for trees with millions of files)")
+    parser.add_argument("--threshold", type=int, default=None,
+                        help="find-similar: largest dHash distance of 64 bits that counts as the same photo "
+                             "(default: 6)")
+    parser.add_argument("--debounce", type=float, default=2.0,
+                        help="watch: seconds a new file must stay unchanged before it is organized")
+    parser.add_argument("--json", action="store_true", help="print the run statistics as JSON")
+    parser.add_argument("--log-level", default="info", choices=list(LOG_LEVELS),
+                        help="debug shows every file, warning only the problems (default: info)")
+    parser.add_argument("--trace", dest="trace_path", default=None,
+                        help="write timing spans of scan, stat, exif, hash and move to this file")
+    parser.add_argument("--trace-format", default="chrome", choices=Tracer.formats,
+                        help="chrome: open in chrome://tracing or ui.perfetto.dev, json: spans and a summary")
+    parser.add_argument("--profile", dest="profile_mode", default=None, choices=Profiler.modes,
+                        help="cProfile (cpu) and/or tracemalloc (memory) the run, the report is logged")
+    parser.add_argument("--profile-out", dest="profile_path", default=None,
+                        help="keep the cProfile stats in this file (for pstats or snakeviz)")
+    return parser
+
+
+def run(args):
+    """Run one action, return its RunStats."""
+    from controller import FileOrganizerController
+
+    controller = FileOrganizerController()
+    controller.set_source_folder(args.folder)
+    if args.workers is not None:
+        controller.set_workers(args.workers)
+    controller.set_recursive(args.recursive)
+    controller.set_dry_run(args.dry_run)
+    controller.set_index(not args.no_index, args.index_path)
+    controller.set_hash_algorithm(args.hash_algorithm)
+    controller.set_similar_threshold(args.threshold)
+    controller.set_link_mode(args.link_mode)
+    controller.set_memory_budget(args.memory_budget)
+    controller.set_extra_roots(args.folders[1:])
+    controller.set_device_workers(args.device_workers)
+    controller.set_journal(not args.no_journal)
+    controller.set_debounce(args.debounce)
+    controller.set_trace(args.trace_path, args.trace_format)
+    controller.set_profile(args.profile_mode, args.profile_path)
+    return getattr(controller, ACTIONS[args.action])()
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if len(args.folders) > 1 and args.action != "find-duplicates":
+        parser.error(f"{args.action} takes one folder, only find-duplicates takes several roots")
+    for folder in args.folders:
+        if not os.path.isdir(folder):
+            parser.error(f"{folder} is not a folder")
+    args.folder = args.folders[0]
+    setup_logging(args.log_level, sys.stderr if args.json else sys.stdout)
+    if args.json:
+        # Keep stdout clean for the JSON report, progress output goes to stderr
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        try:
+            stats = run(args)
+        finally:
+            sys.stdout = stdout
+        report = stats.snapshot()
+        report["message"] = stats.message
+        report["folder"] = args.folder
+        report["roots"] = args.folders
+        print(json.dumps(report, indent=2))
+    else:
+        # The report was already printed when the run finished
+        stats = run(args)
+        if stats.message:
+            print(stats.message)
+    # A run that stopped on an error is a failure for a scheduler, a cancelled run is not
+    return 1 if stats.error else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,38 +1,214 @@
+import os
+
 from file_organizer import FileOrganizer
+from instrumentation import Profiler, Tracer
 from program_utils import ProgramUtils
+from run_stats import RunStats
 
 
 class FileOrganizerController:
+    """
+    Every action runs on its own FileOrganizer and returns the RunStats of
+    that run, so two actions can run at the same time without sharing counters.
+    Pass a RunStats to poll the progress of a running action and a
+    threading.Event to cancel it.
+    """
+
     def __init__(self):
-        self.organizer = None
+        self.source_folder = None
+        self.workers = os.cpu_count() or 1
+        self.dry_run = False
+        self.recursive = None
+        self.use_index = True
+        self.index_path = None
+        self.hash_algorithm = None
+        self.similar_threshold = None
+        self.link_mode = None
+        self.use_journal = True
+        self.debounce_seconds = 2.0
+        self.trace_path = None
+        self.trace_format = "chrome"
+        self.profile_mode = None
+        self.profile_path = None
+        self.memory_budget = None
+        self.extra_roots = []
+        self.device_workers = None
+
+    def create_organizer(self, stats=None, cancel_event=None):
+        """A fresh organizer for one run, or None when no source folder is selected."""
+        if self.source_folder is None:
+            return None
+        tracer = Tracer(self.trace_path, self.trace_format) if self.trace_path else None
+        profiler = Profiler(self.profile_mode, self.profile_path) if self.profile_mode else None
+        return FileOrganizer(self.source_folder, use_index=self.use_index, workers=self.workers,
+                             stats=stats, cancel_event=cancel_event, index_path=self.index_path,
+                             hash_algorithm=self.hash_algorithm, use_journal=self.use_journal,
+                             tracer=tracer, profiler=profiler, memory_budget=self.memory_budget,
+                             device_workers=self.device_workers)
 
     def set_source_folder(self, folder_path):
-        self.organizer = FileOrganizer(folder_path)
-
-    def organize_files(self):
-        if self.organizer:
-            files = ProgramUtils.collect_files(self.organizer.source_folder)
-            self.organizer.organize_files_by_exif(files)
-            return "Files organized successfully!"
-        return "No source folder selected."
-
-    def find_duplicates(self):
-        if self.organizer:
-            files = ProgramUtils.collect_files_with_os_walk(self.organizer.source_folder)
-            self.organizer.find_duplicates(files)
-            return "Duplicate files found!"
-        return "No source folder selected."
-
-    def correct_file_names(self):
-        if self.organizer:
-            files = ProgramUtils.collect_files(self.organizer.source_folder)
-            self.organizer.correct_file_names(files)
-            return "File names corrected successfully!"
-        return "No source folder selected."
-
-    def sort_no_exif(self):
-        if self.organizer:
-            files = ProgramUtils.collect_files(self.organizer.source_folder)
-            self.organizer.move_no_exif_files(files)
-            return "Files sorted in 'NO EXIF' folder successfully!"
-        return "No source folder selected."
+        self.source_folder = folder_path
+
+    def set_workers(self, workers):
+        """Set the amount of worker threads/processes used for hashing and EXIF reading."""
+        self.workers = max(1, int(workers))
+
+    def set_dry_run(self, dry_run):
+        """Only plan and print the moves instead of executing them."""
+        self.dry_run = bool(dry_run)
+
+    def set_recursive(self, recursive):
+        """True/False to force subfolders in or out, None keeps each action's default."""
+        self.recursive = recursive
+
+    def set_index(self, use_index=True, index_path=None):
+        """Turn the on-disk index on or off, index_path overrides its location."""
+        self.use_index = use_index
+        self.index_path = index_path
+
+    def set_hash_algorithm(self, algorithm):
+        """Hash algorithm for duplicate detection, see FileHasher.available_algorithms()."""
+        self.hash_algorithm = algorithm
+
+    def set_similar_threshold(self, threshold):
+        """Largest dHash distance that still counts as a near-duplicate, None for the default."""
+        self.similar_threshold = threshold
+
+    def set_link_mode(self, link_mode):
+        """'auto', 'hardlink' or 'reflink' to replace duplicates with links, None to move them aside."""
+        self.link_mode = link_mode
+
+    def set_journal(self, use_journal):
+        """Record the moves in the journal so runs can be resumed and undone."""
+        self.use_journal = bool(use_journal)
+
+    def set_debounce(self, seconds):
+        """How long a new file must stay unchanged before watch mode picks it up."""
+        self.debounce_seconds = max(0.0, float(seconds))
+
+    def set_extra_roots(self, folders):
+        """More folders (e.g. other disks) that find-duplicates searches together with the source folder."""
+        self.extra_roots = list(folders or [])
+
+    def set_device_workers(self, workers):
+        """Threads that read each disk during find-duplicates, None for the default."""
+        self.device_workers = max(1, int(workers)) if workers else None
+
+    def set_memory_budget(self, megabytes):
+        """Bound the memory of find-duplicates to about this many MiB, spilling to disk beyond it. None for no bound."""
+        self.memory_budget = int(float(megabytes) * 2 ** 20) if megabytes else None
+
+    def set_trace(self, path, trace_format="chrome"):
+        """Record timing spans and write them to path ('chrome' trace or 'json'), None turns tracing off."""
+        self.trace_path = path
+        self.trace_format = trace_format
+
+    def set_profile(self, mode, path=None):
+        """'cpu', 'memory' or 'all' to profile each run, path keeps the cProfile stats, None turns it off."""
+        self.profile_mode = mode
+        self.profile_path = path
+
+    def scan(self, folder, recursive_default, skip_folder=None):
+        recursive = recursive_default if self.recursive is None else self.recursive
+        return ProgramUtils.scan_files(folder, recursive=recursive, skip_folder=skip_folder)
+
+    @staticmethod
+    def no_source_folder():
+        stats = RunStats()
+        stats.message = "No source folder selected."
+        return stats.finish()
+
+    @staticmethod
+    def completed(stats, message):
+        if stats.error:
+            stats.message = stats.message or f"Could not complete: {stats.error}"
+        elif not stats.message:
+            stats.message = message
+        return stats
+
+    def organize_files(self, stats=None, cancel_event=None):
+        organizer = self.create_organizer(stats, cancel_event)
+        if organizer:
+            files = self.scan(organizer.source_folder, False)
+            stats = organizer.organize_files_by_exif(files, self.dry_run)
+            return self.completed(stats, "Files organized successfully!")
+        return self.no_source_folder()
+
+    def find_duplicates(self, stats=None, cancel_event=None):
+        organizer = self.create_organizer(stats, cancel_event)
+        if organizer:
+            # Files of the first root win as originals
+            roots = self.distinct_roots([organizer.source_folder] + self.extra_roots)
+            stats = organizer.find_duplicates(self.scan_roots(roots), self.dry_run, self.link_mode, roots)
+            return self.completed(stats, "Duplicate files found!")
+        return self.no_source_folder()
+
+    @staticmethod
+    def distinct_roots(roots):
+        """The roots resolved (symlinks, '..', trailing slashes) and without repeats, in order."""
+        distinct = []
+        for root in roots:
+            root = os.path.realpath(root)
+            if root not in distinct:
+                distinct.append(root)
+        return distinct
+
+    def scan_roots(self, roots):
+        """
+        Scan every file of the roots once, even when roots overlap: a root inside an earlier
+        root is left out, the part of a later root that is an earlier root is skipped.
+        """
+        recursive = self.recursive is not False
+        for number, root in enumerate(roots):
+            earlier = [os.path.join(other, "") for other in roots[:number]]
+            if recursive and any(root.startswith(other) for other in earlier):
+                continue
+            inner = tuple(other for other in earlier if recursive and other.startswith(os.path.join(root, "")))
+            for entry in self.scan(root, True, ProgramUtils.is_duplicates_folder):
+                if not (inner and entry.path.startswith(inner)):
+                    yield entry
+
+    def find_similar(self, stats=None, cancel_event=None):
+        organizer = self.create_organizer(stats, cancel_event)
+        if organizer:
+            files = self.scan(organizer.source_folder, True, ProgramUtils.is_duplicates_folder)
+            stats = organizer.find_similar(files, self.dry_run, self.similar_threshold)
+            return self.completed(stats, "Similar photos found!")
+        return self.no_source_folder()
+
+    def correct_file_names(self, stats=None, cancel_event=None):
+        organizer = self.create_organizer(stats, cancel_event)
+        if organizer:
+            files = self.scan(organizer.source_folder, False)
+            stats = organizer.correct_file_names(files, self.dry_run)
+            return self.completed(stats, "File names corrected successfully!")
+        return self.no_source_folder()
+
+    def sort_no_exif(self, stats=None, cancel_event=None):
+        organizer = self.create_organizer(stats, cancel_event)
+        if organizer:
+            files = self.scan(organizer.source_folder, False)
+            stats = organizer.move_no_exif_files(files, self.dry_run)
+            return self.completed(stats, "Files sorted in 'NO EXIF' folder successfully!")
+        return self.no_source_folder()
+
+    def resume(self, stats=None, cancel_event=None):
+        organizer = self.create_organizer(stats, cancel_event)
+        if organizer:
+            stats = organizer.resume_run(self.dry_run)
+            return self.completed(stats, "Interrupted run finished!")
+        return self.no_source_folder()
+
+    def undo(self, stats=None, cancel_event=None):
+        organizer = self.create_organizer(stats, cancel_event)
+        if organizer:
+            stats = organizer.undo_last_run(self.dry_run)
+            return self.completed(stats, "Last run undone!")
+        return self.no_source_folder()
+
+    def watch(self, stats=None, cancel_event=None):
+        organizer = self.create_organizer(stats, cancel_event)
+        if organizer:
+            stats = organizer.watch(self.dry_run, self.debounce_seconds)
+            return self.completed(stats, "Stopped watching the folder.")
+        return self.no_source_folder()
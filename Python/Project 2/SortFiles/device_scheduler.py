@@ -0,0 +1,70 @@
+import queue
+import threading
+from collections import deque
+
+"""
+This file is used for:
+- Reading files from several disks at once without thrashing any of them
+
+Every device (st_dev) gets its own queue, sorted by inode, and its own worker
+threads. With one worker per device each disk reads its files one after the
+other in roughly on-disk order, while all disks work in parallel. A single pool
+over all files would interleave reads on one spindle and leave the others idle.
+"""
+
+
+class DeviceScheduler:
+    def __init__(self, workers_per_device=1):
+        self.workers_per_device = max(1, workers_per_device)
+
+    @staticmethod
+    def queues(items, device_of, position_of):
+        """{device: deque of items} with each queue in position (inode) order."""
+        queues = {}
+        for item in items:
+            queues.setdefault(device_of(item), []).append(item)
+        return {device: deque(sorted(pending, key=position_of)) for device, pending in queues.items()}
+
+    def map(self, work, items, device_of, position_of):
+        """
+        Yield work(item) for every item as soon as it is done, so not in input order.
+        The first exception of a worker (e.g. RunCancelled) stops all queues and is raised here.
+        """
+        queues = self.queues(items, device_of, position_of)
+        results = queue.Queue()
+        stop = threading.Event()
+
+        def drain(pending):
+            try:
+                while not stop.is_set():
+                    try:
+                        item = pending.popleft()
+                    except IndexError:
+                        break
+                    results.put((True, work(item)))
+            except BaseException as e:
+                results.put((False, e))
+            finally:
+                # One end marker per thread
+                results.put(None)
+
+        threads = [threading.Thread(target=drain, args=(pending,), name=f"io-{device}-{number}", daemon=True)
+                   for device, pending in queues.items()
+                   for number in range(min(self.workers_per_device, len(pending)))]
+        for thread in threads:
+            thread.start()
+        try:
+            running = len(threads)
+            while running:
+                result = results.get()
+                if result is None:
+                    running -= 1
+                    continue
+                done, value = result
+                if not done:
+                    raise value
+                yield value
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
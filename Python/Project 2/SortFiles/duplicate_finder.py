@@ -0,0 +1,300 @@
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from device_scheduler import DeviceScheduler
+from file_hasher import FileHasher
+from instrumentation import log
+from run_stats import RunCancelled, RunStats
+
+"""
+This file is used for:
+- Finding duplicate files without reading every byte
+
+Stages:
+1. Group files by size (os.stat only, nothing is read)
+2. Hash the first and last few KiB of files that share a size
+3. Hash the full content of files that still collide
+
+Hashing in stage 2 and 3 runs on a thread pool when workers > 1,
+hashlib releases the GIL while it digests large buffers.
+With device_workers it runs on a DeviceScheduler instead: one queue per disk
+in inode order, all disks in parallel (for roots on several mounted disks).
+The algorithm comes from FileHasher, its name is part of the index key
+so hashes of different algorithms never mix.
+"""
+
+
+class DuplicateFinder:
+    partial_chunk_size = 4096
+
+    def __init__(self, index=None, workers=1, run_stats=None, cancel_event=None, algorithm=None,
+                 device_workers=None):
+        """device_workers: hash with this many threads per device instead of one pool of workers"""
+        self.index = index
+        self.hasher = FileHasher(algorithm)
+        self.cancel_event = cancel_event
+        self.run_stats = run_stats if run_stats is not None else RunStats("find-duplicates")
+        self.workers = max(1, workers)
+        self.scheduler = DeviceScheduler(device_workers) if device_workers else None
+        self.file_stats = {}
+        self.order = {}
+        self.total_bytes = 0
+
+    def find_duplicates(self, files):
+        """
+        Return a list of (original, duplicate) pairs.
+        The first file in the input order is kept as the original.
+        """
+        duplicates = []
+        for group in self.group_duplicates(files):
+            original = group[0]
+            for duplicate in group[1:]:
+                duplicates.append((original, duplicate))
+        return duplicates
+
+    def group_duplicates(self, files):
+        """
+        Return groups of identical files, each group in input order.
+        files can be paths or os.DirEntry objects, a generator is consumed while it scans.
+        """
+        self.file_stats = {}
+        self.order = {}
+        self.total_bytes = 0
+
+        with self.run_stats.stage("scan"):
+            sizes = self.group_by_size(files)
+        candidates = [file_name for same_size in sizes.values() if len(same_size) > 1
+                      for file_name in same_size]
+        groups = self.group_candidates(candidates)
+
+        # Keep the report stable: order groups by the first file seen
+        order = self.order
+        for group in groups:
+            group.sort(key=order.get)
+        groups.sort(key=lambda group: order[group[0]])
+        return groups
+
+    def group_candidates(self, candidates):
+        """Stage 2 and 3 for files that share their size with another file, return the groups."""
+        groups = []
+        with self.run_stats.stage("hash", len(candidates)):
+            partial_groups = self.group_by_partial_hash(candidates)
+        full_candidates = []
+        for same_partial in partial_groups.values():
+            if len(same_partial) < 2:
+                continue
+            if self.file_stats[same_partial[0]].st_size <= 2 * self.partial_chunk_size:
+                # The partial hash already covered the whole file
+                groups.append(same_partial)
+            else:
+                full_candidates.extend(same_partial)
+
+        with self.run_stats.stage("hash", len(full_candidates)):
+            full_groups = self.group_by_full_hash(full_candidates)
+        for same_full in full_groups.values():
+            if len(same_full) > 1:
+                groups.append(same_full)
+        return groups
+
+    def group_by_size(self, files):
+        """Stage 1: bucket files by size."""
+        sizes = {}
+        for file in files:
+            self.check_cancelled()
+            file_name = file.path if isinstance(file, os.DirEntry) else file
+            if file_name in self.file_stats:
+                continue
+            try:
+                # DirEntry caches its stat result from the scan
+                with self.run_stats.span("stat"):
+                    stat = file.stat() if isinstance(file, os.DirEntry) else os.stat(file_name)
+            except OSError as e:
+                log.warning("Error reading size for %s: %s", file_name, e)
+                continue
+            size = stat.st_size
+            self.file_stats[file_name] = stat
+            self.order[file_name] = len(self.order)
+            self.total_bytes += size
+            self.run_stats.add("files_found")
+            self.run_stats.advance()
+            self.run_stats.add("total_bytes", size)
+            sizes.setdefault(size, []).append(file_name)
+        return sizes
+
+    def group_by_partial_hash(self, files):
+        """Stage 2: bucket same-size files by a hash of their head and tail."""
+        kind = f"{self.hasher.algorithm}:partial:{self.partial_chunk_size}"
+        hashes = {}
+        for file_name, file_hash in self.hash_files(files, kind, self.calculate_partial_hash):
+            if file_hash is not None:
+                size = self.file_stats[file_name].st_size
+                hashes.setdefault((size, self.digest_key(file_hash)), []).append(file_name)
+        return hashes
+
+    def group_by_full_hash(self, files):
+        """Stage 3: bucket files that still collide by a hash of their full content."""
+        kind = f"{self.hasher.algorithm}:full"
+        hashes = {}
+        for file_name, file_hash in self.hash_files(files, kind, self.calculate_full_hash):
+            if file_hash is not None:
+                hashes.setdefault(self.digest_key(file_hash), []).append(file_name)
+        return hashes
+
+    @staticmethod
+    def digest_key(file_hash):
+        """The key a hash is grouped by, the hex digest itself."""
+        return file_hash
+
+    def hash_files(self, files, kind, calculate):
+        """
+        Yield (file_name, hash) in input order, on the thread pool when workers > 1.
+        With a DeviceScheduler they come in the order they finish.
+        """
+        def work(file_name):
+            self.check_cancelled()
+            with self.run_stats.span("hash", kind=kind):
+                file_hash = self.cached_hash(file_name, kind, calculate)
+            self.run_stats.advance()
+            return file_name, file_hash
+
+        if self.scheduler is not None and len(files) > 1:
+            file_stats = self.file_stats
+            yield from self.scheduler.map(work, files, lambda file_name: file_stats[file_name].st_dev,
+                                          lambda file_name: file_stats[file_name].st_ino)
+            return
+        if self.workers == 1 or len(files) < 2:
+            yield from map(work, files)
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            yield from executor.map(work, files)
+
+    def cached_hash(self, file_name, kind, calculate):
+        """Return the hash from the index when the file is unchanged, else calculate and store it."""
+        if self.index is None:
+            return calculate(file_name)
+        stat = self.file_stats.get(file_name)
+        try:
+            file_hash = self.index.get_hash(file_name, kind, stat)
+        except (OSError, sqlite3.Error) as e:
+            # A locked or broken index is a cache miss
+            log.warning("Error using index for %s: %s", file_name, e)
+            file_hash = None
+        if file_hash is not None:
+            return file_hash
+        file_hash = calculate(file_name)
+        if file_hash is not None:
+            try:
+                self.index.set_hash(file_name, kind, file_hash, stat)
+            except (OSError, sqlite3.Error) as e:
+                log.warning("Error using index for %s: %s", file_name, e)
+        return file_hash
+
+    def check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise RunCancelled("Duplicate search cancelled")
+
+    def calculate_partial_hash(self, file_name):
+        """Hash the first and last partial_chunk_size bytes of a file."""
+        size = self.file_stats[file_name].st_size
+        try:
+            file_hash, read = self.hasher.hash_head_tail(file_name, size, self.partial_chunk_size)
+        except OSError as e:
+            log.warning("Error calculating partial hash for %s: %s", file_name, e)
+            return None
+        self.run_stats.add("bytes_read", read)
+        return file_hash
+
+    def calculate_full_hash(self, file_name):
+        """Hash the full content of a file."""
+        try:
+            file_hash, read = self.hasher.hash_file(file_name)
+        except OSError as e:
+            log.warning("Error calculating hash for %s: %s", file_name, e)
+            return None
+        self.run_stats.add("bytes_read", read)
+        return file_hash
+
+
+class ResidentHashIndex:
+    """
+    Size and hash of every file already organized, kept in memory while watching.
+    A new file is only read when an organized file has the same size, and the
+    organized files are only hashed once, on their first size collision.
+    """
+
+    def __init__(self, index=None, algorithm=None):
+        self.index = index
+        self.hasher = FileHasher(algorithm)
+        self.kind = f"{self.hasher.algorithm}:full"
+        self.sizes = {}
+        self.hashes = {}
+
+    def add(self, file_path, size=None, file_hash=None):
+        if size is None:
+            size = os.path.getsize(file_path)
+        self.sizes.setdefault(size, []).append(file_path)
+        if file_hash is not None:
+            self.hashes[file_path] = file_hash
+
+    def add_files(self, files):
+        """Add paths or os.DirEntry objects, only their size is read."""
+        for file in files:
+            try:
+                if isinstance(file, os.DirEntry):
+                    self.add(file.path, file.stat().st_size)
+                else:
+                    self.add(file)
+            except OSError as e:
+                log.warning("Error reading size for %s: %s", file, e)
+
+    def remove(self, file_path, size):
+        same_size = self.sizes.get(size, [])
+        if file_path in same_size:
+            same_size.remove(file_path)
+        self.hashes.pop(file_path, None)
+
+    def rename(self, old_path, new_path, size):
+        file_hash = self.hashes.get(old_path)
+        self.remove(old_path, size)
+        self.add(new_path, size, file_hash)
+
+    def file_hash(self, file_path):
+        """The full hash of a file from memory, the on-disk index or by reading it."""
+        file_hash = self.hashes.get(file_path)
+        if file_hash is not None:
+            return file_hash
+        if self.index is not None:
+            try:
+                file_hash = self.index.get_hash(file_path, self.kind)
+            except (OSError, sqlite3.Error) as e:
+                log.warning("Error using index for %s: %s", file_path, e)
+        if file_hash is None:
+            try:
+                file_hash = self.hasher.hash_file(file_path)[0]
+            except OSError as e:
+                log.warning("Error calculating hash for %s: %s", file_path, e)
+                return None
+            if self.index is not None:
+                try:
+                    self.index.set_hash(file_path, self.kind, file_hash)
+                except (OSError, sqlite3.Error) as e:
+                    log.warning("Error using index for %s: %s", file_path, e)
+        self.hashes[file_path] = file_hash
+        return file_hash
+
+    def find_duplicate(self, file_path, size=None):
+        """Return (organized file with the same content or None, hash of file_path or None)."""
+        if size is None:
+            size = os.path.getsize(file_path)
+        candidates = [candidate for candidate in self.sizes.get(size, []) if candidate != file_path]
+        if not candidates:
+            return None, None
+        file_hash = self.file_hash(file_path)
+        if file_hash is None:
+            return None, None
+        for candidate in candidates:
+            if self.file_hash(candidate) == file_hash:
+                return candidate, file_hash
+        return None, file_hash
+
@@ -0,0 +1,383 @@
+import os
+import struct
+from datetime import datetime
+
+from instrumentation import log
+
+"""
+This file is used for:
+- Reading the EXIF date without opening the image with PIL
+
+- Reading the creation date of videos and RAW files, which PIL can't open
+
+The format is picked by the magic bytes at the start of the file, and only
+the few KiB that hold the date are read:
+- JPEG: walk the markers up to the APP1 'Exif' segment
+- TIFF and TIFF-based RAW (CR2, NEF, ARW, DNG, ORF, RW2): follow IFD0 and the Exif sub-IFD
+- RAF: the JPEG preview the header points to
+- HEIC/HEIF: find the 'Exif' item through the meta box
+- MP4/MOV/M4V/3GP and CR3 (ISO-BMFF): seek from box header to box header
+  (past the media data) to moov, then the EXIF blocks of a CR3 or the
+  creation time in mvhd
+
+read_date returns (handled, date_taken). handled is False when the
+fast parser can't answer for the file, the caller then falls back to PIL.
+"""
+
+
+class ExifReader:
+    # DateTimeOriginal, DateTimeDigitized, DateTime, same order as ProgramUtils.exif_data_tags
+    date_tags = [36867, 36868, 306]
+    exif_ifd_tag = 0x8769
+    ascii_type = 2
+
+    non_image_extensions = {
+        ".mp4", ".mov", ".m4v", ".avi", ".mkv", ".wmv", ".3gp", ".mts", ".m2ts",
+        ".mp3", ".wav", ".m4a", ".aac", ".flac", ".ogg", ".opus",
+        ".txt", ".pdf", ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx",
+        ".zip", ".rar", ".7z", ".exe", ".msi", ".ini", ".db", ".json", ".xml",
+    }
+    # ISO-BMFF videos are not images, but their date can be read from the mvhd box
+    bmff_video_extensions = {".mp4", ".mov", ".m4v", ".3gp"}
+    heif_brands = {b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1", b"avif"}
+    # Old QuickTime files start without an ftyp box
+    quicktime_boxes = {b"moov", b"mdat", b"wide", b"free", b"skip", b"pnot"}
+    # TIFF, Olympus ORF ('RO' and 'RS') and Panasonic RW2 (0x55)
+    tiff_magic_numbers = {42, 0x4F52, 0x5352, 0x55}
+    tiff_headers = {b"II*\x00", b"MM\x00*", b"IIRO", b"IIRS", b"IIU\x00"}
+    raf_header = b"FUJIFILMCCD-RAW "
+    # Canon's uuid box in the moov box of a CR3, it holds the CMT1 (IFD0) and CMT2 (Exif IFD) boxes
+    canon_uuid = bytes.fromhex("85c0b687820f11e08111f4ce462b6a48")
+    # mvhd times count seconds from 1904-01-01 UTC, this many seconds before the Unix epoch
+    bmff_epoch_offset = 2082844800
+
+    max_segment_size = 1024 * 1024
+
+    @staticmethod
+    def read_date(file_path):
+        """Return (handled, date_taken) with date_taken formatted as 'YYYY-MM-DD'."""
+        extension = os.path.splitext(file_path)[1].lower()
+        if (extension in ExifReader.non_image_extensions
+                and extension not in ExifReader.bmff_video_extensions):
+            return True, None
+
+        try:
+            with open(file_path, 'rb') as file:
+                head = file.read(16)
+                if head[:2] == b"\xff\xd8":
+                    return True, ExifReader.read_jpeg_date(file)
+                if head[:4] in ExifReader.tiff_headers:
+                    return True, ExifReader.read_tiff_date(ExifReader.file_reader(file, 0))
+                if head == ExifReader.raf_header:
+                    return True, ExifReader.read_raf_date(file)
+                if head[4:8] == b"ftyp" and head[8:12] in ExifReader.heif_brands:
+                    return ExifReader.read_heif_date(file)
+                if head[4:8] == b"ftyp" or head[4:8] in ExifReader.quicktime_boxes:
+                    return True, ExifReader.read_bmff_date(file)
+        except (OSError, ValueError, OverflowError, struct.error) as e:
+            log.debug("Fast EXIF reader could not parse %s: %s", file_path, e)
+        return False, None
+
+    ### Readers ###
+
+    @staticmethod
+    def bytes_reader(data):
+        """Return a read_at(offset, length) function over a bytes object."""
+        def read_at(offset, length):
+            chunk = data[offset:offset + length]
+            if len(chunk) != length:
+                raise ValueError("TIFF offset outside of the EXIF block")
+            return chunk
+        return read_at
+
+    @staticmethod
+    def file_reader(file, base_offset):
+        """Return a read_at(offset, length) function over an open file."""
+        def read_at(offset, length):
+            file.seek(base_offset + offset)
+            chunk = file.read(length)
+            if len(chunk) != length:
+                raise ValueError("TIFF offset outside of the file")
+            return chunk
+        return read_at
+
+    ### JPEG ###
+
+    @staticmethod
+    def read_jpeg_date(file, base_offset=0):
+        """Walk the JPEG markers (of a JPEG starting at base_offset) until the APP1 Exif segment or the start of scan."""
+        file.seek(base_offset + 2)
+        while True:
+            marker = file.read(2)
+            if len(marker) != 2 or marker[0] != 0xFF:
+                raise ValueError("invalid JPEG marker")
+            code = marker[1]
+            if code == 0xFF:
+                # Fill byte, the marker code follows
+                file.seek(-1, os.SEEK_CUR)
+                continue
+            if code in (0xD9, 0xDA):
+                # End of image or start of scan, there is no EXIF block
+                return None
+            if 0xD0 <= code <= 0xD7 or code == 0x01:
+                continue
+            length = struct.unpack(">H", file.read(2))[0]
+            if length < 2:
+                raise ValueError("invalid JPEG segment length")
+            segment_end = file.tell() + length - 2
+            if code == 0xE1:
+                segment = file.read(min(length - 2, ExifReader.max_segment_size))
+                if segment[:6] == b"Exif\x00\x00":
+                    return ExifReader.read_tiff_date(ExifReader.bytes_reader(segment[6:]))
+            # Also past the rest of an APP1 segment larger than max_segment_size
+            file.seek(segment_end)
+
+    ### TIFF ###
+
+    @staticmethod
+    def read_tiff_date(read_at):
+        """Read the date tags from a TIFF structure."""
+        byte_order = read_at(0, 2)
+        if byte_order == b"II":
+            endian = "<"
+        elif byte_order == b"MM":
+            endian = ">"
+        else:
+            raise ValueError("invalid TIFF byte order")
+        magic, ifd0_offset = struct.unpack(endian + "HI", read_at(2, 6))
+        if magic not in ExifReader.tiff_magic_numbers:
+            raise ValueError("invalid TIFF magic number")
+
+        tags = ExifReader.read_ifd(read_at, endian, ifd0_offset)
+        exif_offset = tags.get(ExifReader.exif_ifd_tag)
+        if exif_offset is not None:
+            tags.update(ExifReader.read_ifd(read_at, endian, exif_offset))
+
+        for tag in ExifReader.date_tags:
+            date_taken = tags.get(tag)
+            if isinstance(date_taken, str) and date_taken:
+                return date_taken.replace(":", "-").split(" ")[0]
+        return None
+
+    @staticmethod
+    def read_ifd(read_at, endian, offset):
+        """Return {tag: value} for the date tags and the Exif sub-IFD pointer of one IFD."""
+        count = struct.unpack(endian + "H", read_at(offset, 2))[0]
+        entries = read_at(offset + 2, count * 12)
+        tags = {}
+        for index in range(count):
+            tag, field_type, value_count, value = struct.unpack_from(endian + "HHI4s", entries, index * 12)
+            if tag == ExifReader.exif_ifd_tag:
+                tags[tag] = struct.unpack(endian + "I", value)[0]
+            elif tag in ExifReader.date_tags and field_type == ExifReader.ascii_type:
+                if value_count > 4:
+                    value = read_at(struct.unpack(endian + "I", value)[0], value_count)
+                else:
+                    value = value[:value_count]
+                tags[tag] = value.split(b"\x00")[0].decode("ascii", "ignore").strip()
+        return tags
+
+    ### HEIF ###
+
+    @staticmethod
+    def iter_boxes(data, offset=0, end=None):
+        """Yield (box_type, payload_start, box_end) for the ISO-BMFF boxes in data."""
+        end = len(data) if end is None else end
+        while offset + 8 <= end:
+            size, box_type = struct.unpack_from(">I4s", data, offset)
+            header = 8
+            if size == 1:
+                size = struct.unpack_from(">Q", data, offset + 8)[0]
+                header = 16
+            elif size == 0:
+                size = end - offset
+            if size < header:
+                raise ValueError("invalid box size")
+            yield box_type, offset + header, min(offset + size, end)
+            offset += size
+
+    @staticmethod
+    def file_boxes(file, start, end):
+        """Like iter_boxes, but over an open file: only the box headers are read, payloads are skipped."""
+        offset = start
+        while offset + 8 <= end:
+            file.seek(offset)
+            size, box_type = struct.unpack(">I4s", file.read(8))
+            header = 8
+            if size == 1:
+                size = struct.unpack(">Q", file.read(8))[0]
+                header = 16
+            elif size == 0:
+                size = end - offset
+            if size < header:
+                raise ValueError("invalid box size")
+            yield box_type, offset + header, min(offset + size, end)
+            offset += size
+
+    @staticmethod
+    def find_box(file, wanted_type, start, end):
+        """Return (payload_start, payload_end) of the first box of wanted_type between start and end, or None."""
+        for box_type, payload_start, payload_end in ExifReader.file_boxes(file, start, end):
+            if box_type == wanted_type:
+                return payload_start, payload_end
+        return None
+
+    @staticmethod
+    def file_size(file):
+        file.seek(0, os.SEEK_END)
+        return file.tell()
+
+    @staticmethod
+    def read_top_level_box(file, wanted_type, max_size):
+        """Return the payload of the first top-level box of wanted_type, reading only box headers."""
+        box = ExifReader.find_box(file, wanted_type, 0, ExifReader.file_size(file))
+        if box is None:
+            return None
+        start, end = box
+        if end - start > max_size:
+            raise ValueError(f"'{wanted_type.decode()}' box too large")
+        file.seek(start)
+        return file.read(end - start)
+
+    @staticmethod
+    def read_heif_date(file):
+        """Locate the 'Exif' item through iinf/iloc and read its TIFF block."""
+        meta = ExifReader.read_top_level_box(file, b"meta", ExifReader.max_segment_size)
+        if meta is None:
+            return False, None
+
+        # meta is a full box: skip version and flags
+        children = {box_type: (start, end) for box_type, start, end in ExifReader.iter_boxes(meta, 4)}
+        if b"iinf" not in children or b"iloc" not in children:
+            return False, None
+
+        exif_item = ExifReader.find_exif_item(meta, *children[b"iinf"])
+        if exif_item is None:
+            return True, None
+        location = ExifReader.find_item_location(meta, *children[b"iloc"], exif_item)
+        if location is None:
+            return False, None
+
+        item_offset, item_length = location
+        file.seek(item_offset)
+        tiff_header_offset = struct.unpack(">I", file.read(4))[0]
+        tiff_start = item_offset + 4 + tiff_header_offset
+        if item_length and tiff_start >= item_offset + item_length:
+            raise ValueError("invalid Exif item")
+        return True, ExifReader.read_tiff_date(ExifReader.file_reader(file, tiff_start))
+
+    @staticmethod
+    def find_exif_item(meta, start, end):
+        """Return the item id of the 'Exif' item listed in the iinf box."""
+        version = meta[start]
+        offset = start + 4 + (2 if version == 0 else 4)
+        for box_type, infe_start, infe_end in ExifReader.iter_boxes(meta, offset, end):
+            if box_type != b"infe":
+                continue
+            infe_version = meta[infe_start]
+            if infe_version < 2:
+                continue
+            position = infe_start + 4
+            if infe_version == 2:
+                item_id = struct.unpack_from(">H", meta, position)[0]
+                position += 2
+            else:
+                item_id = struct.unpack_from(">I", meta, position)[0]
+                position += 4
+            position += 2  # item_protection_index
+            if meta[position:position + 4] == b"Exif":
+                return item_id
+        return None
+
+    @staticmethod
+    def find_item_location(meta, start, end, wanted_item):
+        """Return (file_offset, length) of the first extent of wanted_item from the iloc box."""
+        version = meta[start]
+        position = start + 4
+
+        def read_sized(size):
+            nonlocal position
+            if size == 0:
+                return 0
+            value = int.from_bytes(meta[position:position + size], "big")
+            position += size
+            return value
+
+        offset_size, length_size = meta[position] >> 4, meta[position] & 0x0F
+        base_offset_size = meta[position + 1] >> 4
+        index_size = meta[position + 1] & 0x0F if version in (1, 2) else 0
+        position += 2
+
+        item_count = read_sized(2 if version < 2 else 4)
+        for _ in range(item_count):
+            item_id = read_sized(2 if version < 2 else 4)
+            construction_method = 0
+            if version in (1, 2):
+                construction_method = read_sized(2) & 0x0F
+            read_sized(2)  # data_reference_index
+            base_offset = read_sized(base_offset_size)
+            extent_count = read_sized(2)
+            extents = []
+            for _ in range(extent_count):
+                read_sized(index_size)
+                extents.append((read_sized(offset_size), read_sized(length_size)))
+            if position > end:
+                raise ValueError("truncated iloc box")
+            if item_id == wanted_item:
+                if construction_method != 0 or not extents:
+                    return None
+                extent_offset, extent_length = extents[0]
+                return base_offset + extent_offset, extent_length
+        return None
+
+    ### ISO-BMFF video and CR3 ###
+
+    @staticmethod
+    def read_bmff_date(file):
+        """The date of a CR3 from its EXIF blocks, of a video from the creation time in moov/mvhd."""
+        moov = ExifReader.find_box(file, b"moov", 0, ExifReader.file_size(file))
+        if moov is None:
+            return None
+
+        for box_type, start, end in ExifReader.file_boxes(file, *moov):
+            if box_type != b"uuid":
+                continue
+            file.seek(start)
+            if file.read(16) != ExifReader.canon_uuid:
+                continue
+            # CMT2 holds the Exif IFD with DateTimeOriginal, CMT1 the IFD0 with DateTime
+            for tiff_box in (b"CMT2", b"CMT1"):
+                box = ExifReader.find_box(file, tiff_box, start + 16, end)
+                if box is not None:
+                    date_taken = ExifReader.read_tiff_date(ExifReader.file_reader(file, box[0]))
+                    if date_taken:
+                        return date_taken
+
+        mvhd = ExifReader.find_box(file, b"mvhd", *moov)
+        if mvhd is None:
+            return None
+        file.seek(mvhd[0])
+        header = file.read(12)
+        # mvhd is a full box: version 1 has 64-bit times, version 0 32-bit ones
+        if header[0] == 1:
+            creation_time = struct.unpack_from(">Q", header, 4)[0]
+        else:
+            creation_time = struct.unpack_from(">I", header, 4)[0]
+        if creation_time == 0:
+            # Not set by the camera
+            return None
+        # The time is UTC: an evening video belongs to the local day it was shot, like an EXIF date.
+        # A garbage 64-bit time raises OverflowError/OSError, read_date then falls back to PIL
+        return datetime.fromtimestamp(creation_time - ExifReader.bmff_epoch_offset).strftime("%Y-%m-%d")
+
+    ### RAF ###
+
+    @staticmethod
+    def read_raf_date(file):
+        """A Fujifilm RAF points to a JPEG preview that carries the EXIF block."""
+        file.seek(84)
+        jpeg_offset = struct.unpack(">I", file.read(4))[0]
+        file.seek(jpeg_offset)
+        if file.read(2) != b"\xff\xd8":
+            raise ValueError("RAF without a JPEG preview")
+        return ExifReader.read_jpeg_date(file, jpeg_offset)
@@ -0,0 +1,108 @@
+import hashlib
+import threading
+from functools import partial
+
+"""
+This file is used for:
+- Choosing the hash algorithm used for duplicate detection
+- Hashing files through one large reusable buffer per thread
+
+Algorithms:
+- blake2b (default, stdlib, 256-bit digest)
+- md5 (the hashes of older versions and reports)
+- sha1 (stdlib, fast on CPUs with SHA instructions)
+- xxh3 and blake3 when the xxhash / blake3 packages are installed
+
+Reads go through readinto() on a memoryview of a per-thread buffer, so no new
+bytes object is made per chunk. This measured faster than hashlib.file_digest
+(which allocates its own 256 KiB buffer per call) and than mmap.
+"""
+
+
+class FileHasher:
+    default_algorithm = "blake2b"
+    buffer_size = 1024 * 1024
+    local = threading.local()
+
+    def __init__(self, algorithm=None):
+        algorithm = algorithm or FileHasher.default_algorithm
+        self.new = FileHasher.constructor(algorithm)
+        if self.new is None:
+            raise ValueError(f"Hash algorithm '{algorithm}' is not available, "
+                             f"choose one of: {', '.join(FileHasher.available_algorithms())}")
+        self.algorithm = algorithm
+
+    @staticmethod
+    def constructor(algorithm):
+        """Return a function that makes a new hash object, None when the backend isn't installed."""
+        if algorithm in ("md5", "sha1"):
+            return getattr(hashlib, algorithm)
+        if algorithm == "blake2b":
+            # 256 bits is plenty for duplicates and keeps the index rows short
+            return partial(hashlib.blake2b, digest_size=32)
+        if algorithm == "xxh3":
+            try:
+                import xxhash
+            except ImportError:
+                return None
+            return xxhash.xxh3_128
+        if algorithm == "blake3":
+            try:
+                from blake3 import blake3
+            except ImportError:
+                return None
+            return blake3
+        return None
+
+    @staticmethod
+    def available_algorithms():
+        return [algorithm for algorithm in ("blake2b", "md5", "sha1", "xxh3", "blake3")
+                if FileHasher.constructor(algorithm) is not None]
+
+    @staticmethod
+    def buffer():
+        """The reusable read buffer of the calling thread, as a memoryview."""
+        view = getattr(FileHasher.local, "view", None)
+        if view is None:
+            view = FileHasher.local.view = memoryview(bytearray(FileHasher.buffer_size))
+        return view
+
+    def hash_file(self, file_name):
+        """Return (hexdigest, bytes read) of the full content of a file."""
+        hash_obj = self.new()
+        view = self.buffer()
+        read = 0
+        with open(file_name, 'rb', buffering=0) as file:
+            while size := file.readinto(view):
+                hash_obj.update(view[:size])
+                read += size
+        return hash_obj.hexdigest(), read
+
+    def hash_head_tail(self, file_name, size, chunk_size):
+        """
+        Return (hexdigest, bytes read) of the first and last chunk_size bytes,
+        or of the whole file when it is no larger than two chunks.
+        """
+        if size <= 2 * chunk_size:
+            return self.hash_file(file_name)
+        hash_obj = self.new()
+        view = self.buffer()[:chunk_size]
+        read = 0
+        with open(file_name, 'rb', buffering=0) as file:
+            for offset in (0, size - chunk_size):
+                file.seek(offset)
+                length = FileHasher.read_full(file, view)
+                hash_obj.update(view[:length])
+                read += length
+        return hash_obj.hexdigest(), read
+
+    @staticmethod
+    def read_full(file, view):
+        """readinto() on an unbuffered file may return less than asked: fill view up to EOF, return the length."""
+        length = 0
+        while length < len(view):
+            size = file.readinto(view[length:])
+            if not size:
+                break
+            length += size
+        return length
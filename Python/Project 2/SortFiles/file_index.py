@@ -0,0 +1,197 @@
+import os
+import sqlite3
+import threading
+import time
+
+"""
+This file is used for:
+- Remembering hashes and EXIF dates between runs
+
+Entries are keyed by path and are only trusted while size, mtime and inode
+still match the file on disk. Stale entries are dropped on lookup.
+Writes are committed in small batches, so another run on the same folder
+only waits for one batch and a crash keeps what was cached before it.
+"""
+
+
+class FileIndex:
+    file_name = ".sortfiles_index.sqlite"
+    # Stored in exif_checked, raise it when the date reader learns new formats:
+    # files checked by an older reader without finding a date are read again
+    # (2: videos and RAW files)
+    exif_reader_version = 2
+    # A write transaction is committed after this many writes or seconds
+    commit_every = 500
+    commit_seconds = 1.0
+    # How long a write waits for another run that holds the lock
+    busy_seconds = 10.0
+    # Entries of deleted files are removed at most this often
+    prune_seconds = 24 * 60 * 60
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(index_path, timeout=self.busy_seconds, check_same_thread=False)
+        self.connection.execute(f"PRAGMA busy_timeout={int(self.busy_seconds * 1000)}")
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                exif_checked INTEGER NOT NULL DEFAULT 0,
+                exif_date TEXT
+            );
+            CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (path, kind)
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value
+            );
+        """)
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+        self.pending_writes = 0
+        self.first_write = None
+
+    @staticmethod
+    def for_folder(source_folder):
+        """Open the index stored in the source folder."""
+        return FileIndex(os.path.join(source_folder, FileIndex.file_name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            try:
+                self.connection.commit()
+            finally:
+                self.connection.close()
+
+    def commit(self):
+        """Commit the pending writes, at the end of a stage."""
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        self.connection.commit()
+        self.pending_writes = 0
+        self.first_write = None
+
+    def _wrote(self):
+        """Count writes and commit the batch once it is large or old enough. Must be called with the lock held."""
+        if self.first_write is None:
+            self.first_write = time.monotonic()
+        self.pending_writes += 1
+        if (self.pending_writes >= self.commit_every
+                or time.monotonic() - self.first_write >= self.commit_seconds):
+            self._commit()
+
+    ### Entries ###
+
+    def _fresh_entry(self, path, stat):
+        """
+        Return the entry row for path, creating or resetting it when the file
+        changed since it was indexed. Must be called with the lock held.
+        """
+        path = os.path.abspath(path)
+        if stat is None:
+            stat = os.stat(path)
+        key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, inode, exif_checked, exif_date FROM files WHERE path = ?",
+            (path,)).fetchone()
+        if row is not None and tuple(row[:3]) == key:
+            return path, row
+
+        self.connection.execute("DELETE FROM hashes WHERE path = ?", (path,))
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (path, size, mtime_ns, inode) VALUES (?, ?, ?, ?)",
+            (path, *key))
+        self._wrote()
+        return path, None
+
+    def get_hash(self, path, kind, stat=None):
+        """Return the cached hash of kind for path, or None."""
+        with self.lock:
+            path, row = self._fresh_entry(path, stat)
+            if row is not None:
+                value = self.connection.execute(
+                    "SELECT value FROM hashes WHERE path = ? AND kind = ?",
+                    (path, kind)).fetchone()
+                if value is not None:
+                    self.hits += 1
+                    return value[0]
+            self.misses += 1
+            return None
+
+    def set_hash(self, path, kind, value, stat=None):
+        with self.lock:
+            path, _ = self._fresh_entry(path, stat)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO hashes (path, kind, value) VALUES (?, ?, ?)",
+                (path, kind, value))
+            self._wrote()
+
+    def get_exif_date(self, path, stat=None):
+        """Return (found, date). found is False when the file was never checked."""
+        with self.lock:
+            path, row = self._fresh_entry(path, stat)
+            if row is not None and row[3] and (row[3] >= self.exif_reader_version or row[4] is not None):
+                self.hits += 1
+                return True, row[4]
+            self.misses += 1
+            return False, None
+
+    def set_exif_date(self, path, date_taken, stat=None):
+        with self.lock:
+            path, _ = self._fresh_entry(path, stat)
+            self.connection.execute(
+                "UPDATE files SET exif_checked = ?, exif_date = ? WHERE path = ?",
+                (self.exif_reader_version, date_taken, path))
+            self._wrote()
+
+    ### Maintenance ###
+
+    def rename(self, old_path, new_path):
+        """Carry the entry of a moved file over to its new path."""
+        old_path = os.path.abspath(old_path)
+        new_path = os.path.abspath(new_path)
+        with self.lock:
+            self.connection.execute("DELETE FROM files WHERE path = ?", (new_path,))
+            self.connection.execute("DELETE FROM hashes WHERE path = ?", (new_path,))
+            self.connection.execute("UPDATE files SET path = ? WHERE path = ?", (new_path, old_path))
+            self.connection.execute("UPDATE hashes SET path = ? WHERE path = ?", (new_path, old_path))
+            self._wrote()
+
+    def prune(self):
+        """Remove entries for files that no longer exist. Returns the amount removed."""
+        with self.lock:
+            paths = [row[0] for row in self.connection.execute("SELECT path FROM files")]
+            removed = [(path,) for path in paths if not os.path.exists(path)]
+            self.connection.executemany("DELETE FROM files WHERE path = ?", removed)
+            self.connection.executemany("DELETE FROM hashes WHERE path = ?", removed)
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_prune', ?)",
+                                    (time.time(),))
+            self._commit()
+            return len(removed)
+
+    def prune_if_due(self):
+        """Prune when the last prune is older than prune_seconds. Returns the amount removed."""
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'last_prune'").fetchone()
+        if row is not None and time.time() - row[0] < self.prune_seconds:
+            return 0
+        return self.prune()
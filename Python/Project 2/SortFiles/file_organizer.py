@@ -1,7 +1,19 @@
 import os
-from logging import exception
+import sqlite3
+from concurrent.futures import Future, ProcessPoolExecutor
 
+from bounded_duplicate_finder import BoundedDuplicateFinder
+from duplicate_finder import DuplicateFinder, ResidentHashIndex
+from file_index import FileIndex
+from folder_watcher import FolderWatcher
+from instrumentation import log
+from link_deduper import LinkDeduper
+from move_journal import MoveJournal
+from move_planner import MovePlan
 from program_utils import ProgramUtils
+from regex_utils import RegexUtils
+from run_stats import RunCancelled, RunStats
+from similar_finder import SimilarFinder
 
 """
 This file is used for:
@@ -13,87 +25,608 @@ This file is used for:
 
 
 class FileOrganizer:
-    def __init__(self, source_folder):
+    exif_batch_size = 64
+
+    def __init__(self, source_folder, use_index=True, workers=1, stats=None, cancel_event=None,
+                 index_path=None, hash_algorithm=None, use_journal=True, tracer=None, profiler=None,
+                 memory_budget=None, device_workers=None):
+        """
+        stats: a RunStats to fill instead of a fresh one, so a caller can poll its progress
+        cancel_event: a threading.Event, when set the run stops cleanly between files
+        index_path: where to keep the index, the source folder by default
+        hash_algorithm: a FileHasher algorithm for duplicate detection, blake2b by default
+        use_journal: record the moves in the source folder's journal, so a run can be resumed or undone
+        tracer: an instrumentation.Tracer that records the spans of the run and exports them at the end
+        profiler: an instrumentation.Profiler that captures the run
+        memory_budget: bytes, find duplicates with the BoundedDuplicateFinder that spills to disk beyond it
+        device_workers: hash with this many threads per disk (1 by default with several roots)
+        """
         self.source_folder = source_folder
+        self.use_index = use_index
+        self.index_path = index_path
+        self.hash_algorithm = hash_algorithm
+        self.use_journal = use_journal
+        self.workers = max(1, workers)
+        self.index = None
+        self.exif_pool = None
+        # {file_path: os.stat_result} cached by the scan, for the index and the journal
+        self.file_stats = {}
+        self.external_stats = stats
+        self.stats = stats if stats is not None else RunStats()
+        self.cancel_event = cancel_event
+        self.tracer = tracer
+        self.profiler = profiler
+        self.memory_budget = memory_budget
+        self.device_workers = device_workers
 
-    def organize_files_by_exif(self, files):
-        """Organize files into folders based on EXIF data."""
-        source_folder = self.source_folder
+    def start_run(self, action):
+        """Open the on-disk index and a RunStats for the duration of one run."""
+        if self.external_stats is not None:
+            self.stats = self.external_stats
+            self.stats.action = action
+        else:
+            self.stats = RunStats(action)
+        self.stats.tracer = self.tracer
+        self.file_stats = {}
+        if self.profiler is not None:
+            self.profiler.start()
+        if self.use_index:
+            try:
+                if self.index_path:
+                    self.index = FileIndex(self.index_path)
+                else:
+                    self.index = FileIndex.for_folder(self.source_folder)
+            except (OSError, sqlite3.Error) as e:
+                # The index is only a cache, a missing folder is reported by the run itself
+                log.warning("Running without the index, it can't be opened: %s", e)
+        return self.stats
+
+    def check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise RunCancelled(f"{self.stats.action} cancelled")
+
+    def cancelled(self, error):
+        log.info("%s", error)
+        self.stats.message = "Run cancelled, files moved so far stay where they are."
+
+    def failed(self, error, reason="Could not complete:"):
+        """Log why the run stopped and keep it on the RunStats, so a headless caller can tell."""
+        log.error("%s %s", reason, error)
+        self.stats.error = str(error) or type(error).__name__
+
+    def finish_run(self):
+        if self.exif_pool is not None:
+            self.exif_pool.shutdown(cancel_futures=True)
+            self.exif_pool = None
+        if self.index is not None:
+            try:
+                # Entries of files deleted outside the organizer, at most once a day
+                self.index.prune_if_due()
+                self.index.close()
+            except sqlite3.Error as e:
+                log.warning("Error closing the index: %s", e)
+            self.index = None
+        self.stats.finish()
+        if self.profiler is not None:
+            self.stats.profile_report = self.profiler.stop()
+        if self.tracer is not None and self.tracer.path:
+            try:
+                self.tracer.export(extra={"run": self.stats.snapshot()})
+            except OSError as e:
+                log.warning("Error writing the trace to %s: %s", self.tracer.path, e)
+        ProgramUtils.present_report(self.stats)
+        return self.stats
+
+    def collect_exif_dates(self, file_paths):
+        """
+        Return {file_path: date_taken} for all files.
+        Files that are unchanged since the last run come from the index,
+        the rest are decoded in worker processes when workers > 1.
+        file_paths may be a generator: batches are handed to the pool while it still scans.
+        Less than one full batch is read inline, so a few new files in watch mode never wait for a pool.
+        """
+        dates = {}
+        batches = []
+        batch = []
+
+        for file_path in file_paths:
+            self.check_cancelled()
+            found, date_taken = (False, None)
+            if self.index is not None:
+                try:
+                    found, date_taken = self.index.get_exif_date(file_path, self.file_stats.get(file_path))
+                except (OSError, sqlite3.Error) as e:
+                    log.warning("Error using index for %s: %s", file_path, e)
+            if found:
+                dates[file_path] = date_taken
+                self.stats.advance()
+                continue
+
+            batch.append(file_path)
+            if len(batch) == self.exif_batch_size:
+                batches.append(self.read_exif_batch(self.exif_executor(), batch))
+                batch = []
+        if batch:
+            batches.append(self.read_exif_batch(self.exif_executor() if batches else None, batch))
 
+        self.stats.set_stage_total(len(dates) + sum(len(batch) for batch, _ in batches))
+        for batch, read_dates in batches:
+            self.check_cancelled()
+            if isinstance(read_dates, Future):
+                with self.stats.span("exif-wait", files=len(batch)):
+                    read_dates = read_dates.result()
+            self.stats.advance(len(batch))
+            for file_path, date_taken in zip(batch, read_dates):
+                dates[file_path] = date_taken
+                if self.index is not None:
+                    try:
+                        self.index.set_exif_date(file_path, date_taken, self.file_stats.get(file_path))
+                    except (OSError, sqlite3.Error) as e:
+                        log.warning("Error using index for %s: %s", file_path, e)
+        self.commit_index()
+
+        self.stats.add("total_files_processed", sum(1 for date_taken in dates.values() if date_taken))
+        return dates
+
+    def exif_executor(self):
+        """The worker pool for EXIF batches, None with one worker. Started once and kept until the run finishes."""
+        if self.workers > 1 and self.exif_pool is None:
+            self.exif_pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self.exif_pool
+
+    def commit_index(self):
+        """Commit the index at the end of a stage, it is only a cache so errors are logged."""
+        if self.index is None:
+            return
         try:
-            for file in files:
+            self.index.commit()
+        except sqlite3.Error as e:
+            log.warning("Error saving the index: %s", e)
+
+    def read_exif_batch(self, executor, batch):
+        """Return (batch, dates), dates is a future when a pool is used."""
+        if executor is None:
+            with self.stats.span("exif", files=len(batch)):
+                return batch, ProgramUtils.read_exif_dates(batch)
+        return batch, executor.submit(ProgramUtils.read_exif_dates, batch)
+
+    def iter_files(self, files):
+        """Yield (file_name, file_path) for names relative to the source folder or os.DirEntry objects."""
+        for file in files:
+            if isinstance(file, os.DirEntry):
+                yield file.name, file.path
+            else:
+                yield file, os.path.join(self.source_folder, file)
+
+    def keep_stat(self, file):
+        """Keep the stat an os.DirEntry cached during the scan, so the index and the journal don't stat again."""
+        if isinstance(file, os.DirEntry):
+            try:
+                self.file_stats[file.path] = file.stat()
+            except OSError as e:
+                log.warning("Error reading %s: %s", file.path, e)
+        return file
+
+    def scan_exif_dates(self, files):
+        """Return ([(file_name, file_path)], {file_path: date_taken}), reading EXIF while files are scanned."""
+        scanned = []
+
+        def file_paths():
+            for file, file_path in self.stats.timed_iter("scan", self.iter_files(map(self.keep_stat, files))):
+                scanned.append((file, file_path))
+                yield file_path
+
+        # The exif stage includes the time the streaming scan takes
+        with self.stats.stage("exif"):
+            dates = self.collect_exif_dates(file_paths())
+        self.stats.add("files_found", len(scanned))
+        return scanned, dates
+
+    def on_moved(self, file_path, dest_path):
+        """Count the move and keep the index entry of the moved file."""
+        self.stats.add("moved_files")
+        self.stats.advance()
+        if self.index is not None:
+            try:
+                self.index.rename(file_path, dest_path)
+            except sqlite3.Error as e:
+                log.warning("Error using index for %s: %s", dest_path, e)
 
-                file_path = os.path.join(source_folder, file)
-                date_taken = ProgramUtils.get_exif_data(file_path)
-                print(f"Processing {file_path}, EXIF date taken: {date_taken}")
+    def execute_plan(self, plan, dry_run=False, run_id=None, journaled=()):
+        """
+        Print the plan on a dry run, otherwise create all folders in one pass and move in bulk.
+        The plan is journaled before anything moves. run_id continues an interrupted run,
+        whose plan is already in the journal: only moves missing from journaled are written.
+        """
+        if dry_run:
+            self.stats.message = f"Dry run, planned operations:\n{plan.preview()}"
+            log.info("%s", self.stats.message)
+            return 0
 
-                if date_taken:
-                    dest_path = ProgramUtils.create_date_folder(source_folder, date_taken, file)
-                    print(f"Moving to {dest_path}")
-                    ProgramUtils.move_file(file_path, dest_path)
-                    ProgramUtils.moved_files += 1
+        journal = None
+        if self.use_journal and (len(plan) or run_id):
+            journal = MoveJournal.for_folder(self.source_folder)
+        try:
+            with self.stats.stage("move", len(plan)):
+                if journal is not None and run_id is None:
+                    journal.begin_run(self.stats.action)
+                    journal.record_plan(plan)
+                elif journal is not None:
+                    journal.continue_run(run_id)
+                    # A destination that was taken since the crash got a new name
+                    journal.record_moves([move for move in plan.moves if move not in journaled])
+                self.stats.add("folders_created", plan.create_folders())
+                moved = plan.execute(self.on_moved, self.check_cancelled, journal, self.stats)
+            self.commit_index()
+            if journal is not None:
+                # A cancelled or crashed run gets no end record and can be resumed
+                journal.end_run()
+            return moved
+        finally:
+            if journal is not None:
+                journal.close()
+
+    def resume_run(self, dry_run=False):
+        """Finish the moves of the last interrupted run from its journal. Returns the RunStats of the run."""
+        plan = MovePlan()
+        stats = self.start_run("resume")
+
+        try:
+            run_id, run = MoveJournal.for_folder(self.source_folder).unfinished_run()
+            if run_id is None:
+                stats.message = "No interrupted run to resume."
+                return self.finish_run()
+            stats.action = f"resume {run['action']}"
+
+            already_moved = []
+            pending = MoveJournal.pending_moves(run)
+            for record in pending:
+                file_path, dest_path = record["src"], record["dst"]
+                if MovePlan.linked(file_path, dest_path):
+                    # The crash came between the hard link and the unlink of this move
+                    already_moved.append((file_path, dest_path))
+                elif os.path.exists(file_path):
+                    plan.add(file_path, os.path.dirname(dest_path), os.path.basename(dest_path))
+                elif MoveJournal.matches(record, dest_path):
+                    # Moved, but the crash came before its done record was synced
+                    already_moved.append((file_path, dest_path))
                 else:
-                    print(f"No EXIF data: {file}")
-                    no_exif_folder = ProgramUtils.create_no_exif_folder(source_folder)
-                    no_exif_dest_path = os.path.join(no_exif_folder, file)
-                    ProgramUtils.move_file(file_path, no_exif_dest_path)
-                    ProgramUtils.no_exif_files += 1
-
-            ProgramUtils.present_report(files,
-                                        ProgramUtils.folders_created,
-                                        ProgramUtils.moved_files,
-                                        ProgramUtils.total_files_processed,
-                                        ProgramUtils.no_exif_files,
-                                        ProgramUtils.duplicates_counter)
+                    log.warning("Skipped %s: it is gone and not at %s", file_path, dest_path)
+            log.info("Resuming run %s: %d moves left, %d already done", run_id, len(plan), len(already_moved))
 
+            if already_moved and not dry_run:
+                with MoveJournal.for_folder(self.source_folder) as journal:
+                    journal.continue_run(run_id)
+                    for file_path, dest_path in already_moved:
+                        if os.path.lexists(file_path) and not MovePlan.finish_link(file_path, dest_path):
+                            continue
+                        journal.record_done(file_path, dest_path)
+                        self.on_moved(file_path, dest_path)
+            self.execute_plan(plan, dry_run, run_id, {(record["src"], record["dst"]) for record in pending})
+
+        except RunCancelled as e:
+            self.cancelled(e)
         except Exception as e:
-            print(f"No files found to sort. {e}")
+            self.failed(e)
+        return self.finish_run()
+
+    def undo_last_run(self, dry_run=False):
+        """Move the files of the last completed run back. Returns the RunStats of the run."""
+        stats = self.start_run("undo")
+
+        try:
+            journal = MoveJournal.for_folder(self.source_folder)
+            run_id, run = journal.last_completed_run()
+            if run_id is None:
+                stats.message = "No completed run to undo."
+                return self.finish_run()
+            moves = [record for record in reversed(run["plans"])
+                     if (record["src"], record["dst"]) in run["done"]
+                     and (record["src"], record["dst"]) not in run["undone"]]
+            if dry_run:
+                lines = [f"Move {record['dst']} -> {record['src']}" for record in moves]
+                stats.message = f"Dry run, undo of {run['action']} run {run_id}:\n" + "\n".join(lines)
+                log.info("%s", stats.message)
+                return self.finish_run()
+
+            with journal, stats.stage("move", len(moves)):
+                journal.continue_run(run_id)
+                for record in moves:
+                    self.check_cancelled()
+                    file_path, dest_path = record["src"], record["dst"]
+                    if os.path.exists(file_path) or not MoveJournal.matches(record, dest_path):
+                        log.warning("Skipped %s: it changed or %s is taken", dest_path, file_path)
+                        continue
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    if MovePlan.move(dest_path, file_path):
+                        journal.record_done(file_path, dest_path, "undone")
+                        stats.add("total_files_processed")
+                        self.on_moved(dest_path, file_path)
+                # Remove the folders the run created, only when they are empty again
+                for folder in reversed(run["folders"]):
+                    try:
+                        os.rmdir(folder)
+                        log.info("Removed folder: %s", folder)
+                    except OSError:
+                        pass
+                journal.end_run("undo-end")
 
-    def find_duplicates(self, files):
-        """Find and move duplicate files to a 'Duplicates' folder."""
+        except RunCancelled as e:
+            self.cancelled(e)
+        except Exception as e:
+            self.failed(e)
+        return self.finish_run()
+
+    def organize_files_by_exif(self, files, dry_run=False):
+        """Organize files into folders based on EXIF data. Returns the RunStats of the run."""
         source_folder = self.source_folder
+        plan = MovePlan()
+        stats = self.start_run("organize")
+
+        try:
+            files, dates = self.scan_exif_dates(files)
+
+            # Move decisions stay serialized and in input order
+            for file, file_path in files:
 
-        files_with_hash = {}
+                date_taken = dates[file_path]
+                log.debug("Processing %s, EXIF date taken: %s", file_path, date_taken)
+
+                date_folder = ProgramUtils.date_folder_path(source_folder, date_taken) if date_taken else None
+                if date_folder:
+                    plan.add(file_path, date_folder, file, self.file_stats.get(file_path))
+                else:
+                    log.debug("No EXIF data: %s", file)
+                    plan.add(file_path, ProgramUtils.no_exif_folder_path(source_folder), file,
+                             self.file_stats.get(file_path))
+                    stats.add("no_exif_files")
+
+            self.execute_plan(plan, dry_run)
+
+        except RunCancelled as e:
+            self.cancelled(e)
+        except Exception as e:
+            self.failed(e, "No files found to sort.")
+        return self.finish_run()
+
+    def watch(self, dry_run=False, debounce_seconds=2.0, poll_seconds=1.0):
+        """
+        Keep organizing the files that arrive in the source folder until the run is cancelled
+        (or Ctrl+C). Returns the RunStats of the whole watch.
+        """
+        stats = self.start_run("watch")
 
         try:
+            with FolderWatcher(self.source_folder, debounce_seconds, poll_seconds) as watcher:
+                # One stat-only scan of what is organized already (the subfolders),
+                # after that only new files are read
+                with stats.stage("scan"):
+                    resident = ResidentHashIndex(self.index, self.hash_algorithm)
+                    organized = ProgramUtils.scan_files(self.source_folder, recursive=True,
+                                                        skip_folder=ProgramUtils.is_duplicates_folder)
+                    resident.add_files(entry for entry in organized
+                                       if entry.path != os.path.join(self.source_folder, entry.name))
+                    watcher.add(watcher.existing_files())
+                log.info("Watching %s (%s), %d files organized already", self.source_folder,
+                         type(watcher.backend).__name__, sum(len(paths) for paths in resident.sizes.values()))
+
+                while True:
+                    self.check_cancelled()
+                    new_files = watcher.wait_for_files()
+                    if new_files:
+                        self.organize_new_files(new_files, resident, dry_run)
+
+        except (RunCancelled, KeyboardInterrupt):
+            log.info("Stopped watching.")
+            stats.message = "Stopped watching."
+        except Exception as e:
+            self.failed(e)
+        return self.finish_run()
 
-            for file_name in files:
+    def organize_new_files(self, file_paths, resident, dry_run=False):
+        """Run one batch of new files through the exif, dedupe and move stages."""
+        source_folder = self.source_folder
+        stats = self.stats
+        plan = MovePlan()
+        stats.add("files_found", len(file_paths))
+        with stats.stage("exif", len(file_paths)):
+            dates = self.collect_exif_dates(file_paths)
 
-                # Create hash value
-                file_hash = ProgramUtils.calculate_file_hash(file_name)
+        added = []
+        with stats.stage("hash", len(file_paths)):
+            for file_path in file_paths:
+                self.check_cancelled()
+                file_name = os.path.basename(file_path)
+                try:
+                    size = os.path.getsize(file_path)
+                except OSError as e:
+                    log.warning("Error reading size for %s: %s", file_path, e)
+                    continue
+                original, file_hash = resident.find_duplicate(file_path, size)
+                stats.advance()
+                if original is not None:
+                    log.debug("Duplicate %s of %s goes to 'Duplicates' folder", file_path, original)
+                    plan.add(file_path, ProgramUtils.duplicates_folder_path(source_folder), file_name)
+                    stats.add("duplicates")
+                    continue
 
-                # Check if hash is already found in the files_with_hash list
-                if file_hash in files_with_hash:
-                    dest_folder = ProgramUtils.create_duplicates_folder(source_folder)
-                    dest_path = os.path.join(dest_folder, os.path.basename(file_name))
-                    ProgramUtils.move_file(file_name, dest_path)
-                    ProgramUtils.duplicates_counter += 1
-                    ProgramUtils.total_files_processed += 1
-                    print(f"Moved duplicate {file_name} to 'Duplicates' folder")
-                    ProgramUtils.duplicate_report_flag_value = True
+                date_taken = dates.get(file_path)
+                date_folder = ProgramUtils.date_folder_path(source_folder, date_taken) if date_taken else None
+                if date_folder:
+                    plan.add(file_path, date_folder, file_name)
                 else:
-                    files_with_hash[file_hash] = file_name
+                    log.debug("No EXIF data: %s", file_name)
+                    plan.add(file_path, ProgramUtils.no_exif_folder_path(source_folder), file_name)
+                    stats.add("no_exif_files")
+                # Added right away, so the later files of this batch are checked against it too
+                resident.add(file_path, size, file_hash)
+                added.append((file_path, size))
+
+        self.execute_plan(plan, dry_run)
+        # The destinations as executed, a name taken since planning was replaced
+        destinations = dict(plan.moves)
+        for file_path, size in added:
+            if not os.path.exists(file_path):
+                resident.rename(file_path, destinations[file_path], size)
 
-            ProgramUtils.present_report(files,
-                                ProgramUtils.folders_created,
-                                ProgramUtils.moved_files,
-                                ProgramUtils.total_files_processed,
-                                ProgramUtils.no_exif_files,
-                                ProgramUtils.duplicates_counter)
+    def move_no_exif_files(self, files, dry_run=False):
+        """Move files without an EXIF date to the 'NO EXIF' folder. Returns the RunStats of the run."""
+        source_folder = self.source_folder
+        plan = MovePlan()
+        stats = self.start_run("sort-no-exif")
+
+        try:
+            files, dates = self.scan_exif_dates(files)
 
+            for file, file_path in files:
+
+                if dates[file_path]:
+                    continue
+
+                log.debug("No EXIF data: %s", file)
+                plan.add(file_path, ProgramUtils.no_exif_folder_path(source_folder), file,
+                         self.file_stats.get(file_path))
+                stats.add("no_exif_files")
+
+            self.execute_plan(plan, dry_run)
+
+        except RunCancelled as e:
+            self.cancelled(e)
         except Exception as e:
-            print(f"Could not complete: {e}")
+            self.failed(e, "No files found to sort.")
+        return self.finish_run()
 
+    def find_duplicates(self, files, dry_run=False, link_mode=None, roots=None):
+        """
+        Find and move duplicate files to a 'Duplicates' folder. Returns the RunStats of the run.
+        link_mode ('auto', 'hardlink' or 'reflink') replaces them with links to the original instead.
+        roots: all folders files come from (the source folder first), a duplicate goes to the
+        'Duplicates' folder of its own root so it never moves to another disk. With more than one
+        root every disk is read by its own queue, see DeviceScheduler.
+        """
+        roots = roots or [self.source_folder]
+        plan = MovePlan()
+        stats = self.start_run("find-duplicates")
 
-    # def correct_file_names(self, collected_files):
-    #     """Correct file names by removing unsupported characters."""
-    #     for file in collected_files:
-    #         corrected_name = RegexUtils.correct_file_name(file)
-    #         original_path = os.path.join(self.source_folder, file)
-    #         corrected_path = os.path.join(self.source_folder, corrected_name)
-    #         if original_path != corrected_path:
-    #             os.rename(original_path, corrected_path)
-    #             print(f"Renamed {file} to {corrected_name}")
+        try:
+            device_workers = self.device_workers or (1 if len(roots) > 1 else None)
+            if self.memory_budget:
+                finder = BoundedDuplicateFinder(self.index, self.workers, stats, self.cancel_event,
+                                                self.hash_algorithm, self.memory_budget,
+                                                device_workers=device_workers)
+            else:
+                finder = DuplicateFinder(self.index, self.workers, stats, self.cancel_event,
+                                         self.hash_algorithm, device_workers)
+
+            duplicates = finder.find_duplicates(files)
+            self.commit_index()
+            if link_mode:
+                self.link_duplicates(duplicates, LinkDeduper(link_mode), dry_run)
+                return self.finish_run()
+
+            for original, file_name in duplicates:
+                plan.add(file_name, ProgramUtils.duplicates_folder_path(self.root_of(file_name, roots)))
+                stats.add("duplicates")
+                stats.add("total_files_processed")
+                log.debug("Duplicate %s of %s goes to 'Duplicates' folder", file_name, original)
+
+            self.execute_plan(plan, dry_run)
+
+        except RunCancelled as e:
+            self.cancelled(e)
+        except Exception as e:
+            self.failed(e)
+        return self.finish_run()
+
+    def root_of(self, file_path, roots):
+        """The longest root that contains file_path, the source folder when none does."""
+        containing = [root for root in roots if file_path.startswith(os.path.join(root, ""))]
+        return max(containing, key=len) if containing else self.source_folder
+
+    def link_duplicates(self, duplicates, deduper, dry_run=False):
+        """Replace each (original, duplicate) pair with a link, only after a byte compare."""
+        stats = self.stats
+        stats.add("duplicates", len(duplicates))
+        if dry_run:
+            lines = [f"Link {file_name} -> {original} ({deduper.mode})" for original, file_name in duplicates]
+            stats.message = "Dry run, planned operations:\n" + "\n".join(lines)
+            log.info("%s", stats.message)
+            return
+
+        journal = MoveJournal.for_folder(self.source_folder) if self.use_journal and duplicates else None
+        try:
+            with stats.stage("link", len(duplicates)):
+                if journal is not None:
+                    journal.begin_run(f"{stats.action} --link {deduper.mode}")
+                for original, file_name in duplicates:
+                    self.check_cancelled()
+                    link_type, reclaimed = deduper.replace(original, file_name)
+                    stats.add("total_files_processed")
+                    stats.advance()
+                    if link_type is not None:
+                        stats.add("linked_files")
+                        stats.add("bytes_reclaimed", reclaimed)
+                        if journal is not None:
+                            journal.record_link(file_name, original, link_type)
+            if journal is not None:
+                journal.end_run()
+        finally:
+            if journal is not None:
+                journal.close()
+
+    def find_similar(self, files, dry_run=False, threshold=None):
+        """
+        Move near-duplicate photos (resized, recompressed copies) to the 'Duplicates' folder.
+        threshold is the largest Hamming distance between two dHashes that still counts as the same photo.
+        Returns the RunStats of the run.
+        """
+        plan = MovePlan()
+        stats = self.start_run("find-similar")
+
+        try:
+            finder = SimilarFinder(self.index, self.workers, stats, self.cancel_event, threshold)
+            duplicates_folder = ProgramUtils.duplicates_folder_path(self.source_folder)
+
+            similar = finder.find_similar(files)
+            self.commit_index()
+            for original, file_name, distance in similar:
+                plan.add(file_name, duplicates_folder)
+                stats.add("duplicates")
+                stats.add("total_files_processed")
+                log.debug("Near-duplicate %s of %s (distance %d) goes to 'Duplicates' folder",
+                          file_name, original, distance)
+
+            self.execute_plan(plan, dry_run)
+
+        except RunCancelled as e:
+            self.cancelled(e)
+        except Exception as e:
+            self.failed(e)
+        return self.finish_run()
+
+    def correct_file_names(self, files, dry_run=False):
+        """Correct file names by removing unsupported characters. Returns the RunStats of the run."""
+        plan = MovePlan()
+        stats = self.start_run("correct-names")
+
+        try:
+            for file, file_path in self.stats.timed_iter("scan", self.iter_files(files)):
+                self.check_cancelled()
+                stats.add("files_found")
+                name, extension = os.path.splitext(file)
+                corrected_name = RegexUtils.correct_file(name) + extension
+                if corrected_name != file and RegexUtils.correct_file(name):
+                    plan.add(file_path, os.path.dirname(file_path), corrected_name)
+                    stats.add("total_files_processed")
+                    log.debug("Renaming %s to %s", file, corrected_name)
+
+            self.execute_plan(plan, dry_run)
+
+        except RunCancelled as e:
+            self.cancelled(e)
+        except Exception as e:
+            self.failed(e)
+        return self.finish_run()
 
     # def sort_files_no_exif(self, collected_files):
     #     """Sort files in the 'NO EXIF' folder based on dates in filenames."""
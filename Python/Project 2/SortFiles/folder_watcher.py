@@ -0,0 +1,174 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from instrumentation import log
+from program_utils import ProgramUtils
+
+"""
+This file is used for:
+- Noticing new files in a watched folder without rescanning it
+- Holding them back until they are complete (debounce and a stable size check)
+
+Backends:
+- InotifyWatcher: Linux inotify through ctypes, the kernel reports every
+  closed or moved-in file, nothing is scanned between events
+- PollingWatcher: everywhere else, the folder is only listed again when its
+  mtime changes, which happens whenever an entry is added or renamed
+"""
+
+
+class InotifyWatcher:
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    event_header = struct.Struct("iIII")
+
+    def __init__(self, folder):
+        self.folder = folder
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"inotify_add_watch failed for {folder}")
+
+    def wait(self, timeout):
+        """Return the paths that were created, written or moved in within timeout seconds."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        paths = set()
+        offset = 0
+        header_size = self.event_header.size
+        while offset + header_size <= len(data):
+            _, mask, _, name_length = self.event_header.unpack_from(data, offset)
+            name = data[offset + header_size:offset + header_size + name_length].rstrip(b"\0")
+            offset += header_size + name_length
+            if mask & self.IN_Q_OVERFLOW:
+                # The kernel dropped events, fall back to one listing of the folder
+                paths.update(entry.path for entry in ProgramUtils.scan_files(self.folder))
+            elif name and not mask & self.IN_ISDIR:
+                paths.add(os.path.join(self.folder, os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher:
+    def __init__(self, folder):
+        self.folder = folder
+        self.folder_mtime = None
+        self.known = set()
+
+    def wait(self, timeout):
+        """Sleep timeout seconds, then list the folder only when its mtime changed."""
+        time.sleep(timeout)
+        try:
+            folder_mtime = os.stat(self.folder).st_mtime_ns
+        except OSError as e:
+            log.warning("Error reading %s: %s", self.folder, e)
+            return set()
+        if folder_mtime == self.folder_mtime:
+            return set()
+        self.folder_mtime = folder_mtime
+        current = {entry.path for entry in ProgramUtils.scan_files(self.folder)}
+        new = current - self.known
+        self.known = current
+        return new
+
+    def close(self):
+        pass
+
+
+class FolderWatcher:
+    """Pick the inotify backend on Linux and polling elsewhere, collect new files until they are complete."""
+
+    def __init__(self, folder, debounce_seconds=2.0, poll_seconds=1.0, use_inotify=True):
+        self.folder = folder
+        self.debounce_seconds = debounce_seconds
+        self.poll_seconds = poll_seconds
+        self.backend = None
+        if use_inotify and sys.platform.startswith("linux"):
+            try:
+                self.backend = InotifyWatcher(folder)
+            except (OSError, AttributeError) as e:
+                log.info("inotify not available, polling instead: %s", e)
+        if self.backend is None:
+            self.backend = PollingWatcher(folder)
+        # path -> (size, mtime_ns, time of the last change)
+        self.pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.backend.close()
+
+    def existing_files(self):
+        """The files already in the folder when watching starts."""
+        paths = {entry.path for entry in ProgramUtils.scan_files(self.folder)}
+        if isinstance(self.backend, PollingWatcher):
+            self.backend.known |= paths
+            self.backend.folder_mtime = os.stat(self.folder).st_mtime_ns
+        return paths
+
+    @staticmethod
+    def is_candidate(file_path):
+        """Skip the program's own files and the temporary names of downloads in progress."""
+        name = os.path.basename(file_path)
+        return not (name.startswith(".") or ProgramUtils.is_program_file(name)
+                    or name.endswith((".part", ".tmp", ".crdownload", ".partial")))
+
+    def add(self, paths):
+        now = time.monotonic()
+        for file_path in paths:
+            if self.is_candidate(file_path):
+                self.pending[file_path] = (None, None, now)
+
+    def wait_for_files(self):
+        """
+        Wait up to poll_seconds for new files, return the files that are complete (often none).
+        A file is complete when its size and mtime didn't change for debounce_seconds,
+        so a burst of uploads comes out as one batch.
+        """
+        # Short waits, so the caller can check for a cancel between them
+        self.add(self.backend.wait(self.poll_seconds))
+        return self.ready_files()
+
+    def ready_files(self):
+        now = time.monotonic()
+        ready = []
+        for file_path, (size, mtime_ns, changed) in list(self.pending.items()):
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                # Gone again, e.g. a temporary file that was renamed
+                del self.pending[file_path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                self.pending[file_path] = (stat.st_size, stat.st_mtime_ns, now)
+            elif now - changed >= self.debounce_seconds:
+                ready.append(file_path)
+                del self.pending[file_path]
+        return sorted(ready)
@@ -0,0 +1,203 @@
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import nullcontext
+
+"""
+This file is used for:
+- Leveled logging instead of print, so per-file messages cost nothing when they are off
+- Timing spans around the hot paths: scan, stat, exif, hash and move
+- An optional cProfile and/or tracemalloc capture of a run
+- Exporting the spans as JSON or as a Chrome trace (chrome://tracing, ui.perfetto.dev)
+
+Levels:
+    debug    every file: processed, moved, EXIF tags found
+    info     what a run did: folders created, resume/watch notices
+    warning  files that were skipped or could not be read
+    error    a run that could not complete
+The report at the end of a run is printed at every level, see ProgramUtils.present_report.
+
+Nothing is recorded unless a Tracer is attached to the run's RunStats,
+RunStats.span() then hands out one shared no-op context manager.
+A Tracer adds every span to per-name totals as it closes, but keeps only the
+first max_events spans for the trace file, so memory stays bounded on runs
+over millions of files.
+"""
+
+log = logging.getLogger("sortfiles")
+
+LOG_LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+    "quiet": logging.CRITICAL + 1,
+}
+
+NO_SPAN = nullcontext()
+
+
+def setup_logging(level="info", stream=None):
+    """Send the program's messages to stream (stdout by default) as plain lines, like print did."""
+    handler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log.handlers = [handler]
+    log.setLevel(LOG_LEVELS[level])
+    log.propagate = False
+
+
+class Span:
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.record(self.name, self.category, self.start, time.perf_counter_ns() - self.start, self.args)
+
+
+class Tracer:
+    """
+    Collects timing spans of one run.
+    totals are {name: [count, total_ns, max_ns]} over all spans, stages are named 'stage:<name>'.
+    events are the first max_events spans as (name, category, start_ns, duration_ns, thread, args)
+    tuples for the trace file, dropped counts the spans after those.
+    Spans of worker processes are not collected, the parent records the wait for their batches.
+    """
+    formats = ["chrome", "json"]
+    max_events = 200_000
+
+    def __init__(self, path=None, trace_format="chrome"):
+        self.path = path
+        self.trace_format = trace_format
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.events = []
+        self.dropped = 0
+        self.started = time.perf_counter_ns()
+
+    def span(self, name, category="file", **args):
+        return Span(self, name, category, args)
+
+    def record(self, name, category, start, duration, args):
+        key = name if category == "file" else f"{category}:{name}"
+        with self.lock:
+            totals = self.totals.get(key)
+            if totals is None:
+                self.totals[key] = [1, duration, duration]
+            else:
+                totals[0] += 1
+                totals[1] += duration
+                if duration > totals[2]:
+                    totals[2] = duration
+            if len(self.events) < self.max_events:
+                self.events.append((name, category, start, duration, threading.get_ident(), args))
+            else:
+                self.dropped += 1
+
+    def summary(self):
+        """{name: {count, seconds, max_seconds}}, slowest total first."""
+        with self.lock:
+            totals = sorted(((name, tuple(values)) for name, values in self.totals.items()),
+                            key=lambda item: item[1][1], reverse=True)
+        return {name: {"count": count, "seconds": total / 1e9, "max_seconds": longest / 1e9}
+                for name, (count, total, longest) in totals}
+
+    def report(self):
+        lines = [f"{name:>14}: {values['count']:8d} spans {values['seconds']:10.3f}s "
+                 f"(max {values['max_seconds'] * 1000:.1f} ms)"
+                 for name, values in self.summary().items()]
+        if self.dropped:
+            lines.append(f"The trace file holds the first {len(self.events)} spans, {self.dropped} more are only counted")
+        return "Spans:\n" + "\n".join(lines) if lines else ""
+
+    def chrome_trace(self):
+        """The Chrome trace event format: complete ('X') events in microseconds."""
+        pid = os.getpid()
+        threads = {}
+        trace_events = []
+        for name, category, start, duration, thread, args in self.events:
+            trace_events.append({
+                "name": name, "cat": category, "ph": "X", "pid": pid,
+                "tid": threads.setdefault(thread, len(threads)),
+                "ts": (start - self.started) / 1000, "dur": duration / 1000, "args": args,
+            })
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms", "droppedSpans": self.dropped}
+
+    def json_trace(self):
+        spans = [{"name": name, "category": category, "start": (start - self.started) / 1e9,
+                  "seconds": duration / 1e9, "thread": thread, "args": args}
+                 for name, category, start, duration, thread, args in self.events]
+        return {"summary": self.summary(), "spans": spans, "dropped_spans": self.dropped}
+
+    def export(self, path=None, extra=None):
+        """Write the spans to path in trace_format, extra (e.g. the run snapshot) is added to the file."""
+        path = path or self.path
+        trace = self.chrome_trace() if self.trace_format == "chrome" else self.json_trace()
+        if extra:
+            trace.update(extra)
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(trace, file)
+        log.info("Trace of %d spans written to %s", len(self.events), path)
+        return path
+
+
+class Profiler:
+    """
+    cProfile ('cpu'), tracemalloc ('memory') or both ('all') around one run.
+    cProfile only sees the thread that starts it: use --workers 1 to profile
+    the hashing and EXIF work too, worker processes are never profiled.
+    tracemalloc slows every allocation, so compare timings only between runs without it.
+    """
+    modes = ["cpu", "memory", "all"]
+
+    def __init__(self, mode="cpu", output_path=None, limit=20):
+        self.mode = mode
+        self.output_path = output_path
+        self.limit = limit
+        self.profile = None
+        self.memory = None
+
+    def start(self):
+        if self.mode in ("memory", "all"):
+            import tracemalloc
+            tracemalloc.start()
+        if self.mode in ("cpu", "all"):
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def stop(self):
+        """Stop capturing, return the text report."""
+        lines = []
+        if self.profile is not None:
+            self.profile.disable()
+            import pstats
+            if self.output_path:
+                # Open with snakeviz or `python -m pstats`
+                self.profile.dump_stats(self.output_path)
+                lines.append(f"CPU profile written to {self.output_path}")
+            text = io.StringIO()
+            pstats.Stats(self.profile, stream=text).sort_stats("cumulative").print_stats(self.limit)
+            lines.append(text.getvalue().strip())
+            self.profile = None
+        if self.mode in ("memory", "all"):
+            import tracemalloc
+            if tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                self.memory = {"current": current, "peak": peak}
+                lines.append(f"Traced memory: {current / 2 ** 20:.1f} MiB now, {peak / 2 ** 20:.1f} MiB peak")
+                lines.extend(str(stat) for stat in snapshot.statistics("lineno")[:self.limit])
+        return "\n".join(lines)
@@ -0,0 +1,152 @@
+import errno
+import os
+import shutil
+
+from instrumentation import log
+from program_utils import ProgramUtils
+
+"""
+This file is used for:
+- Replacing verified duplicates with a hardlink or a reflink to the original
+  instead of moving them to the 'Duplicates' folder
+
+Every replacement:
+1. Checks that both files are on the same filesystem and not already linked
+2. Compares both files byte by byte, the hash match alone is not trusted
+3. Links the original to a temporary name next to the duplicate
+4. Checks that neither file changed since the compare
+5. Renames the temporary name over the duplicate (os.replace is atomic)
+
+An interrupted run leaves either the old duplicate or the new link in place,
+at worst a temporary '.sortfiles_link_' file that the next scan skips.
+Every replacement is written to the move journal as a 'link' record, undo
+does not turn links back into separate files.
+
+Modes:
+- hardlink: both names share one inode (and its permissions and timestamps)
+- reflink: a copy-on-write clone via ioctl FICLONE (Linux, btrfs/XFS), the
+  duplicate keeps its own metadata and later edits don't touch the original
+- auto: reflink where the filesystem supports it, hardlink otherwise
+"""
+
+
+class LinkDeduper:
+    modes = ["auto", "hardlink", "reflink"]
+    FICLONE = 0x40049409
+    compare_chunk_size = 1024 * 1024
+
+    def __init__(self, mode="auto"):
+        if mode not in LinkDeduper.modes:
+            raise ValueError(f"Unknown link mode '{mode}', choose one of: {', '.join(LinkDeduper.modes)}")
+        self.mode = mode
+        self.reflink_supported = {}
+
+    def replace(self, original, duplicate):
+        """
+        Replace duplicate with a link to original.
+        Return (link type, bytes reclaimed), link type is None when the file was left alone.
+        """
+        try:
+            original_stat = os.stat(original)
+            duplicate_stat = os.stat(duplicate)
+        except OSError as e:
+            log.warning("Error reading %s: %s", duplicate, e)
+            return None, 0
+
+        if original_stat.st_dev != duplicate_stat.st_dev:
+            log.warning("Skipped %s: not on the same filesystem as %s", duplicate, original)
+            return None, 0
+        if original_stat.st_ino == duplicate_stat.st_ino:
+            log.debug("Skipped %s: already linked to %s", duplicate, original)
+            return None, 0
+        if not LinkDeduper.files_equal(original, duplicate, original_stat.st_size, duplicate_stat.st_size):
+            log.warning("Skipped %s: content differs from %s", duplicate, original)
+            return None, 0
+
+        temp_path = os.path.join(os.path.dirname(duplicate),
+                                 f"{ProgramUtils.program_file_prefix}link_{os.getpid()}_{os.path.basename(duplicate)}")
+        link_type = None
+        try:
+            if self.mode != "hardlink" and self.reflink_supported.get(duplicate_stat.st_dev, True):
+                if self.reflink(original, temp_path, duplicate):
+                    link_type = "reflink"
+                else:
+                    self.reflink_supported[duplicate_stat.st_dev] = False
+                    if self.mode == "reflink":
+                        log.warning("Skipped %s: the filesystem doesn't support reflinks", duplicate)
+                        return None, 0
+            if link_type is None:
+                os.link(original, temp_path)
+                link_type = "hardlink"
+
+            # Neither file may have changed since it was compared: a changed duplicate would lose
+            # its new bytes, a changed original would put different content under its name
+            for path, before in ((duplicate, duplicate_stat), (original, original_stat)):
+                if not LinkDeduper.unchanged(path, before):
+                    log.warning("Skipped %s: %s changed during the run", duplicate, path)
+                    LinkDeduper.remove(temp_path)
+                    return None, 0
+            os.replace(temp_path, duplicate)
+        except OSError as e:
+            log.warning("Error linking %s to %s: %s", duplicate, original, e)
+            LinkDeduper.remove(temp_path)
+            return None, 0
+
+        log.debug("Replaced %s with a %s to %s", duplicate, link_type, original)
+        # Space is only freed when this was the last name of the duplicate's inode
+        reclaimed = duplicate_stat.st_size if duplicate_stat.st_nlink == 1 else 0
+        return link_type, reclaimed
+
+    def reflink(self, original, temp_path, duplicate):
+        """Clone original to temp_path with FICLONE, return False when the filesystem can't."""
+        try:
+            import fcntl
+        except ImportError:
+            return False
+        try:
+            with open(original, 'rb') as source, open(temp_path, 'xb') as target:
+                fcntl.ioctl(target.fileno(), LinkDeduper.FICLONE, source.fileno())
+        except OSError as e:
+            LinkDeduper.remove(temp_path)
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                return False
+            raise
+        # A clone is a new file, keep the duplicate's own permissions and timestamps
+        shutil.copystat(duplicate, temp_path)
+        return True
+
+    @staticmethod
+    def files_equal(first, second, first_size=None, second_size=None):
+        """Compare two files byte by byte."""
+        if first_size is not None and first_size != second_size:
+            return False
+        chunk_size = LinkDeduper.compare_chunk_size
+        first_view = memoryview(bytearray(chunk_size))
+        second_view = memoryview(bytearray(chunk_size))
+        try:
+            with open(first, 'rb') as first_file, open(second, 'rb') as second_file:
+                while True:
+                    # Buffered readinto fills the whole chunk until the end of the file
+                    first_read = first_file.readinto(first_view)
+                    second_read = second_file.readinto(second_view)
+                    if first_read != second_read or first_view[:first_read] != second_view[:second_read]:
+                        return False
+                    if not first_read:
+                        return True
+        except OSError as e:
+            log.warning("Error comparing %s and %s: %s", first, second, e)
+            return False
+
+    @staticmethod
+    def unchanged(path, before):
+        """True when path still has the size, mtime and inode of an earlier stat."""
+        current = os.stat(path)
+        return (current.st_size, current.st_mtime_ns, current.st_ino) == (
+            before.st_size, before.st_mtime_ns, before.st_ino)
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -1,9 +1,11 @@
 from app_gui import AppGUI
+from instrumentation import setup_logging
 import tkinter as tk
 
 # Version : 1.0.2.15
 
 def main():
+    setup_logging()
     root = tk.Tk()
     AppGUI(root)
     root.mainloop()
@@ -0,0 +1,247 @@
+import json
+import os
+import time
+import uuid
+
+"""
+This file is used for:
+- Recording every planned and completed move of a run in an append-only journal
+- Resuming a run that was interrupted, without reading EXIF again
+- Undoing the last completed run
+
+The journal is a JSON-lines file in the source folder. Records of a run:
+    begin   the action that started it
+    mkdir   a folder the run creates
+    plan    a move: src, dst and the size/mtime fingerprint of the file
+    done    a completed move
+    link    a duplicate replaced by a link to its original (a record only, undo leaves links alone)
+    end     the run finished (not written when it was cancelled or crashed)
+    undone  a move that was reversed, undo-end when the undo finished
+
+The journal only grows while runs are appended. Once it passes compact_bytes,
+the next new run first rewrites it with what resume and undo still use: the
+unfinished runs and the last keep_runs completed runs that were not undone,
+reduced to their completed moves.
+
+All plan records are written and fsynced before the first file moves. done
+records are buffered and fsynced in groups (every sync_every records or
+sync_seconds), so journaling adds no fsync per file. A crash can lose the last
+group of done records; resume then finds those files already at their
+destination and records them as done.
+"""
+
+
+class MoveJournal:
+    file_name = ".sortfiles_journal.jsonl"
+    sync_every = 512
+    sync_seconds = 1.0
+    compact_bytes = 4 * 1024 * 1024
+    keep_runs = 20
+
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.file = None
+        self.buffer = []
+        self.last_sync = time.monotonic()
+        self.run_id = None
+
+    @staticmethod
+    def for_folder(source_folder):
+        return MoveJournal(os.path.join(source_folder, MoveJournal.file_name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    ### Writing ###
+
+    def begin_run(self, action):
+        """Start a new run, return its id. A journal past compact_bytes is compacted first."""
+        if self.file is None and MoveJournal.file_size(self.journal_path) > self.compact_bytes:
+            self.compact()
+        self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.write({"op": "begin", "action": action, "time": time.time()})
+        return self.run_id
+
+    def continue_run(self, run_id):
+        """Add records to an earlier run (resume, undo), nothing is written for it."""
+        self.run_id = run_id
+
+    def record_plan(self, plan):
+        """Write the folders and moves of a MovePlan before any of them happen."""
+        for folder in plan.folders:
+            self.write({"op": "mkdir", "path": folder})
+        self.record_moves(plan.moves, plan.file_stats)
+
+    def record_moves(self, moves, file_stats=None):
+        """Write plan records for [(file_path, dest_path)] and fsync them, file_stats: {file_path: stat} known already."""
+        file_stats = file_stats or {}
+        for file_path, dest_path in moves:
+            record = {"op": "plan", "src": file_path, "dst": dest_path}
+            record.update(MoveJournal.fingerprint(file_path, file_stats.get(file_path)))
+            self.write(record)
+        self.sync()
+
+    def record_done(self, file_path, dest_path, op="done"):
+        """Record a completed move, op is 'undone' when an undo moved it back."""
+        self.write({"op": op, "src": file_path, "dst": dest_path})
+        if len(self.buffer) >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_seconds:
+            self.sync()
+
+    def record_link(self, duplicate, original, link_type):
+        self.write({"op": "link", "src": duplicate, "dst": original, "type": link_type})
+        if len(self.buffer) >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_seconds:
+            self.sync()
+
+    def end_run(self, op="end"):
+        self.write({"op": op})
+        self.sync()
+
+    def write(self, record):
+        record["run"] = self.run_id
+        self.buffer.append(json.dumps(record))
+
+    def sync(self):
+        """Append the buffered records and fsync them as one group."""
+        if self.buffer:
+            if self.file is None:
+                self.file = open(self.journal_path, "a", encoding="utf-8")
+                if self.file.tell() and not MoveJournal.ends_with_newline(self.journal_path):
+                    # Close off a line torn by a crash, so the next record starts clean
+                    self.file.write("\n")
+            self.file.write("\n".join(self.buffer) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.buffer = []
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    @staticmethod
+    def file_size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    @staticmethod
+    def ends_with_newline(path):
+        with open(path, "rb") as file:
+            file.seek(-1, os.SEEK_END)
+            return file.read(1) == b"\n"
+
+    @staticmethod
+    def fingerprint(file_path, stat=None):
+        """Size and mtime survive a rename, so they identify the moved file at its destination."""
+        if stat is None:
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                return {}
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    ### Reading ###
+
+    def read_runs(self):
+        """Return {run_id: run} in journal order, a torn last line from a crash is ignored."""
+        runs = {}
+        try:
+            with open(self.journal_path, encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    run = runs.setdefault(record.get("run"), {
+                        "begin": None, "action": None, "folders": [], "plans": [], "planned": set(),
+                        "done": set(), "links": [], "undone": set(), "ended": False, "undo_ended": False})
+                    op = record.get("op")
+                    if op == "begin":
+                        run["begin"] = record
+                        run["action"] = record.get("action")
+                    elif op == "mkdir":
+                        run["folders"].append(record["path"])
+                    elif op == "plan":
+                        # Older versions wrote the plan of a resumed run again
+                        if (record["src"], record["dst"]) not in run["planned"]:
+                            run["planned"].add((record["src"], record["dst"]))
+                            run["plans"].append(record)
+                    elif op == "done":
+                        run["done"].add((record["src"], record["dst"]))
+                    elif op == "link":
+                        run["links"].append(record)
+                    elif op == "undone":
+                        run["undone"].add((record["src"], record["dst"]))
+                    elif op == "end":
+                        run["ended"] = True
+                    elif op == "undo-end":
+                        run["undo_ended"] = True
+        except FileNotFoundError:
+            pass
+        return runs
+
+    def compact(self):
+        """
+        Rewrite the journal without the runs resume and undo no longer use: finished runs that were
+        undone or are older than the last keep_runs. A kept finished run keeps only its completed moves.
+        """
+        runs = self.read_runs()
+        finished = [run_id for run_id, run in runs.items()
+                    if run["ended"] and not run["undo_ended"] and (run["done"] or run["links"])]
+        keep = set(finished[-self.keep_runs:])
+        lines = []
+        for run_id, run in runs.items():
+            if run["ended"] and run_id not in keep:
+                continue
+            records = [run["begin"]] if run["begin"] else []
+            records += [{"op": "mkdir", "path": folder, "run": run_id} for folder in run["folders"]]
+            plans = run["plans"]
+            if run["ended"]:
+                plans = [plan for plan in plans if (plan["src"], plan["dst"]) in run["done"]
+                         and (plan["src"], plan["dst"]) not in run["undone"]]
+            records += plans
+            records += [{"op": "done", "src": plan["src"], "dst": plan["dst"], "run": run_id}
+                        for plan in plans if (plan["src"], plan["dst"]) in run["done"]]
+            records += run["links"]
+            if run["ended"]:
+                records.append({"op": "end", "run": run_id})
+            lines += [json.dumps(record) for record in records]
+
+        temp_path = self.journal_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write("".join(line + "\n" for line in lines))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.journal_path)
+        return len(lines)
+
+    def unfinished_run(self):
+        """Return (run_id, run) of the last run without an end record, or (None, None)."""
+        for run_id, run in reversed(list(self.read_runs().items())):
+            if not run["ended"]:
+                return run_id, run
+        return None, None
+
+    def last_completed_run(self):
+        """Return (run_id, run) of the last finished run that wasn't undone yet, or (None, None)."""
+        for run_id, run in reversed(list(self.read_runs().items())):
+            if run["ended"] and not run["undo_ended"] and run["done"]:
+                return run_id, run
+        return None, None
+
+    @staticmethod
+    def pending_moves(run):
+        """The planned moves of a run that have no done record, in plan order."""
+        return [plan for plan in run["plans"] if (plan["src"], plan["dst"]) not in run["done"]]
+
+    @staticmethod
+    def matches(plan, file_path):
+        """True when file_path still has the size and mtime recorded in the plan, never for a plan without them."""
+        current = MoveJournal.fingerprint(file_path)
+        return bool(current) and all(key in plan and plan[key] == value for key, value in current.items())
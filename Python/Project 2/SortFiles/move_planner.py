@@ -0,0 +1,172 @@
+import errno
+import os
+import shutil
+
+from instrumentation import NO_SPAN, log
+
+"""
+This file is used for:
+- Planning every move before anything is touched
+- Creating all destination folders in one pass
+- Moving in bulk: a hard link and unlink on the same filesystem, copy and delete across devices
+- Never overwriting: a file that appears at a destination after planning gets a new name
+- Finishing a move that was interrupted between its hard link and unlink
+
+A plan can be printed as a dry-run preview without executing it.
+With a MoveJournal every completed move is recorded, see move_journal.py.
+"""
+
+
+class MovePlan:
+    def __init__(self):
+        self.moves = []
+        # {file_path: os.stat_result} from the scan, the journal fingerprints moves with it
+        self.file_stats = {}
+        self.folders = []
+        self.planned_destinations = set()
+        self.existing_folders = {}
+
+    def __len__(self):
+        return len(self.moves)
+
+    def add(self, file_path, dest_folder, file_name=None, stat=None):
+        """
+        Plan a move of file_path into dest_folder, return the planned destination path.
+        stat: the os.stat_result of file_path when the scan has it already
+        """
+        if stat is not None:
+            self.file_stats[file_path] = stat
+        if file_name is None:
+            file_name = os.path.basename(file_path)
+        if dest_folder not in self.existing_folders:
+            self.existing_folders[dest_folder] = os.path.isdir(dest_folder)
+            if not self.existing_folders[dest_folder]:
+                self.folders.append(dest_folder)
+
+        dest_path = self.unique_destination(dest_folder, file_name)
+        self.planned_destinations.add(dest_path)
+        self.moves.append((file_path, dest_path))
+        return dest_path
+
+    def unique_destination(self, dest_folder, file_name):
+        """Never overwrite: add a counter when the name is taken on disk or earlier in the plan."""
+        dest_path = os.path.join(dest_folder, file_name)
+        name, extension = os.path.splitext(file_name)
+        counter = 1
+        while dest_path in self.planned_destinations or (
+                self.existing_folders[dest_folder] and os.path.lexists(dest_path)):
+            dest_path = os.path.join(dest_folder, f"{name}_{counter}{extension}")
+            counter += 1
+        return dest_path
+
+    def preview(self):
+        """Describe the plan without executing it."""
+        lines = [f"Create folder: {folder}" for folder in self.folders]
+        lines += [f"Move {file_path} -> {dest_path}" for file_path, dest_path in self.moves]
+        return "\n".join(lines)
+
+    def create_folders(self):
+        """Create every planned folder, return the amount created."""
+        created = 0
+        for folder in self.folders:
+            try:
+                os.makedirs(folder, exist_ok=True)
+                self.existing_folders[folder] = True
+                created += 1
+                log.info("Created folder: %s", folder)
+            except OSError as e:
+                log.warning("Unable to create folder %s: %s", folder, e)
+        self.folders = []
+        return created
+
+    def execute(self, on_moved=None, before_move=None, journal=None, stats=None):
+        """
+        Create the folders and run all moves, return the amount of files moved.
+        A destination that was re-planned is updated in moves.
+        before_move() is called between files and may raise to stop the run cleanly.
+        journal: a MoveJournal that already holds the plan, every completed move is recorded in it.
+        stats: a RunStats, every move is a 'move' span in its trace
+        """
+        self.create_folders()
+        moved = 0
+        for number, (file_path, dest_path) in enumerate(self.moves):
+            if before_move is not None:
+                before_move()
+            if MovePlan.finish_link(file_path, dest_path):
+                # Linked by a run that crashed before the unlink, only the unlink was left
+                done = True
+            else:
+                if os.path.lexists(dest_path):
+                    # Taken after the plan was made: plan a free name, journaled before the move
+                    dest_path = self.unique_destination(os.path.dirname(dest_path), os.path.basename(dest_path))
+                    self.planned_destinations.add(dest_path)
+                    self.moves[number] = (file_path, dest_path)
+                    if journal is not None:
+                        journal.record_moves([(file_path, dest_path)])
+                with stats.span("move") if stats is not None else NO_SPAN:
+                    done = MovePlan.move(file_path, dest_path)
+            if done:
+                moved += 1
+                if journal is not None:
+                    journal.record_done(file_path, dest_path)
+                if on_moved is not None:
+                    on_moved(file_path, dest_path)
+        return moved
+
+    @staticmethod
+    def linked(file_path, dest_path):
+        """
+        True when file_path and dest_path are two hard links to the same file: a move that was
+        interrupted after its link. A file with a single link never counts, on a case-insensitive
+        filesystem both names can be the same entry.
+        """
+        try:
+            source = os.lstat(file_path)
+            dest = os.lstat(dest_path)
+        except OSError:
+            return False
+        return (source.st_dev, source.st_ino) == (dest.st_dev, dest.st_ino) and source.st_nlink > 1
+
+    @staticmethod
+    def finish_link(file_path, dest_path):
+        """Finish a move that was interrupted after its link by removing file_path, return True when done."""
+        if not MovePlan.linked(file_path, dest_path):
+            return False
+        try:
+            os.unlink(file_path)
+        except OSError as e:
+            log.warning("Error moving file to %s: %s", dest_path, e)
+            return False
+        log.debug("Finished the interrupted move of %s to %s", file_path, dest_path)
+        return True
+
+    @staticmethod
+    def move(file_path, dest_path):
+        """
+        Move without ever replacing dest_path: os.rename overwrites on POSIX, a hard link fails when
+        the name is taken. Without hard links (across devices, FAT/exFAT) the name is checked first.
+        """
+        try:
+            try:
+                os.link(file_path, dest_path, follow_symlinks=False)
+            except FileExistsError:
+                raise
+            except (OSError, NotImplementedError) as e:
+                if os.path.lexists(dest_path):
+                    raise FileExistsError(errno.EEXIST, "Destination already exists", dest_path)
+                if getattr(e, "errno", None) == errno.EXDEV:
+                    shutil.move(file_path, dest_path)
+                else:
+                    os.rename(file_path, dest_path)
+            else:
+                try:
+                    os.unlink(file_path)
+                except OSError:
+                    # Leave the file where it was, not in two places
+                    os.unlink(dest_path)
+                    raise
+            log.debug("Moved %s to %s", file_path, dest_path)
+            return True
+        except OSError as e:
+            log.warning("Error moving file to %s: %s", dest_path, e)
+            return False
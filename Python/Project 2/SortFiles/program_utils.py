@@ -1,84 +1,36 @@
 import os
+import re
 import shutil
-import time
 from datetime import datetime
-from hashlib import md5
-from logging import exception
 
-from PIL import Image
+from exif_reader import ExifReader
+from file_hasher import FileHasher
+from instrumentation import log
 
 
 ### Gather data ###
 class ProgramUtils:
-    folders_created = 0
-    moved_files = 0
-    total_files_processed = 0
-    no_exif_files = 0
-    duplicates_counter = 0
-    folders_created_flag_value = False
-    duplicate_report_flag_value = False
-    no_exif_report_flag_value = False
+    program_file_prefix = ".sortfiles_"
+    output_folders = {"Duplicates", "NO EXIF"}
+    date_folder_pattern = re.compile(r"\d{4}-\d{2}")
 
     ### Reporting ###
     @staticmethod
-    def reset_report():
-        ProgramUtils.folders_created = 0
-        ProgramUtils.moved_files = 0
-        ProgramUtils.total_files_processed = 0
-        ProgramUtils.no_exif_files = 0
-        ProgramUtils.duplicates_counter = 0
-        # return (ProgramUtils.folders_created,
-        #         ProgramUtils.moved_files,
-        #         ProgramUtils.total_files_processed,
-        #         ProgramUtils.no_exif_files,
-        #         ProgramUtils.duplicates_counter)
-
-    @staticmethod
-    def check_folders_created_report_flag():
-        return ProgramUtils.folders_created_flag_value
-
-    @staticmethod
-    def duplicate_report_flag():
-        return ProgramUtils.duplicate_report_flag_value
-
-    @staticmethod
-    def no_exif_report_flag():
-        return ProgramUtils.no_exif_report_flag_value
-
-    @staticmethod
-    def reset_bool_value_for_flags():
-        ProgramUtils.folders_created_flag_value = False
-        ProgramUtils.duplicate_report_flag_value = False
-        ProgramUtils.no_exif_report_flag_value = False
-
-    @staticmethod
-    def present_report(files, folders_created, moved_files, total_files_processed, no_exif_files, duplicates_counter):
-        file_status = ""
-
-        file_status += f"total files found: {ProgramUtils.total_files(files)}\n"
-        file_status += f"Total files processed: {total_files_processed}\n"
-        if ProgramUtils.duplicate_report_flag() is True:
-            file_status += f"Files moved to Duplicates folder: {moved_files}\n"
-            file_status += f"Duplicate files found: {duplicates_counter}\n"
-        if ProgramUtils.no_exif_report_flag() is True:
-            file_status += f"Files moved to 'NO EXIF'  folder: {no_exif_files}\n"
-        if ProgramUtils.check_folders_created_report_flag() is True:
-            file_status += f"Folders created: {folders_created}\n"
-
-        print(f"Rapport:\n{file_status}")
-        ProgramUtils.reset_report()
-        ProgramUtils.reset_bool_value_for_flags()
+    def present_report(stats):
+        """Print the report of one run, the counters live on the run's RunStats. Printed at every log level."""
+        print(f"Rapport:\n{stats.report()}")
 
 
     @staticmethod
     def has_exif(file_path):
         """Check if an image has EXIF data."""
         try:
+            from PIL import Image
             image = Image.open(file_path)
             exif_data = image.getexif()
             return exif_data is not None
         except Exception as e:
-            print(f"Error reading EXIF data for {file_path}: {e}")
+            log.warning("Error reading EXIF data for %s: %s", file_path, e)
         return False
 
     @staticmethod
@@ -88,43 +40,97 @@ class ProgramUtils:
         for tag in date_tags:
             date_taken = exif_data.get(tag)
             if date_taken:
-                print(f"Found EXIF data for tag {tag}: {date_taken}")
+                log.debug("Found EXIF data for tag %s: %s", tag, date_taken)
                 return date_taken.replace(":", "-").split(" ")[0]
-        print(f"Available EXIF data: {exif_data}")
+        log.debug("Available EXIF data: %s", exif_data)
         return None
 
     @staticmethod
     def get_exif_data(file_path):
-        """Extract EXIF data."""
+        """Extract the EXIF date, safe to run in a worker process."""
         try:
+            handled, date_taken = ExifReader.read_date(file_path)
+        except Exception as e:
+            # One unreadable file must not end the whole batch
+            log.warning("Error reading the date of %s: %s", file_path, e)
+            handled, date_taken = False, None
+        if handled:
+            return date_taken
+
+        # The fast reader can't answer for this file, fall back to PIL
+        try:
+            from PIL import Image
             with Image.open(file_path) as image:
                 exif_data = image.getexif()
                 if exif_data:
-                    ProgramUtils.total_files_processed += 1
-                    ProgramUtils.no_exif_report_flag_value = True
                     return ProgramUtils.exif_data_tags(exif_data)
         except Exception as e:
-            print(f"Error getting EXIF data from {file_path}: {e}")
+            log.warning("Error getting EXIF data from %s: %s", file_path, e)
         return None
 
     @staticmethod
-    def calculate_file_hash(file_name):
-        """Calculate the hash of a file for duplicate detection."""
-        hash_obj = md5()
+    def read_exif_dates(file_paths):
+        """Extract the EXIF dates of a batch of files, one worker task per batch."""
+        return [ProgramUtils.get_exif_data(file_path) for file_path in file_paths]
+
+    @staticmethod
+    def calculate_file_hash(file_name, algorithm="md5"):
+        """Calculate the hash of a file for duplicate detection, md5 matches older reports."""
         try:
-            with open(file_name, 'rb') as file:
-                while chunk := file.read(8192):
-                    hash_obj.update(chunk)
-            return hash_obj.hexdigest()
+            return FileHasher(algorithm).hash_file(file_name)[0]
         except Exception as e:
-            print(f"Error calculating hash for {file_name}: {e}")
+            log.warning("Error calculating hash for %s: %s", file_name, e)
             return None
 
     ### Gather files ###
 
+    @staticmethod
+    def is_program_file(file_name):
+        """Files the program keeps in the source folder itself, like the index."""
+        return os.path.basename(file_name).startswith(ProgramUtils.program_file_prefix)
+
+    @staticmethod
+    def is_output_folder(folder_name):
+        """Folders the program creates itself: 'Duplicates', 'NO EXIF' and the YYYY-MM folders."""
+        return (folder_name in ProgramUtils.output_folders
+                or ProgramUtils.date_folder_pattern.fullmatch(folder_name) is not None)
+
+    @staticmethod
+    def is_duplicates_folder(folder_name):
+        return folder_name == "Duplicates"
+
+    @staticmethod
+    def scan_files(source_folder, recursive=False, skip_folder=None):
+        """
+        Yield an os.DirEntry for every file while the scan is still running.
+        Subfolders are visited top-down like os.walk, skip_folder(name) decides
+        which subfolders are left out (the program's own output folders by default).
+        """
+        if skip_folder is None:
+            skip_folder = ProgramUtils.is_output_folder
+
+        folders = [source_folder]
+        while folders:
+            folder = folders.pop()
+            subfolders = []
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_file():
+                                if not ProgramUtils.is_program_file(entry.name):
+                                    yield entry
+                            elif recursive and entry.is_dir(follow_symlinks=False) and not skip_folder(entry.name):
+                                subfolders.append(entry.path)
+                        except OSError as e:
+                            log.warning("Cannot access %s: %s", entry.path, e)
+            except (PermissionError, FileNotFoundError) as e:
+                log.warning("Cannot access %s: %s", folder, e)
+            folders.extend(reversed(subfolders))
+
     @staticmethod
     def collect_files(source_folder):
-        files = [f for f in os.listdir(source_folder) if os.path.isfile(os.path.join(source_folder, f))]
+        files = [entry.name for entry in ProgramUtils.scan_files(source_folder)]
         return files
 
     @staticmethod
@@ -135,55 +141,58 @@ class ProgramUtils:
     ### Move files ###
 
     @staticmethod
-    def move_file(file_path, dest_path):
+    def move_file(file_path, dest_path, stats=None):
         try:
             shutil.move(file_path, dest_path)
-            print(f"Moved {file_path} to {dest_path}")
-            ProgramUtils.moved_files += 1
+            log.debug("Moved %s to %s", file_path, dest_path)
+            if stats is not None:
+                stats.add("moved_files")
+            return True
         except Exception as e:
-            (print(f"Error moving file to {dest_path}: {e}"))
+            log.warning("Error moving file to %s: %s", dest_path, e)
+            return False
 
     @staticmethod
     def collect_files_with_os_walk(source_folder):
+        file_list = [entry.path for entry in
+                     ProgramUtils.scan_files(source_folder, recursive=True,
+                                             skip_folder=ProgramUtils.is_duplicates_folder)]
+        return file_list
 
-        file_list = []
-
-        try:
-            for root, dirs, files in os.walk(source_folder):
-
-                if "Duplicates" in dirs:
-                    dirs.remove("Duplicates")
 
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    file_list.append(file_path)
+    ### Create folders ###
 
-            return file_list
-        except (PermissionError, FileNotFoundError) as e:
-            print(f"Cannot access {source_folder}: {e}")
-        except Exception as e:
-            print(f"Unexpected error at {source_folder}: {e}")
+    @staticmethod
+    def date_folder_path(source_folder, date_taken):
+        """Return the YYYY-MM folder for the EXIF date if valid, without creating it."""
+        if ProgramUtils.validate_date(date_taken):
+            year, month = date_taken.split("-")[:2]
+            return os.path.join(source_folder, f"{year}-{month}")
+        return None
 
+    @staticmethod
+    def no_exif_folder_path(source_folder):
+        return os.path.join(source_folder, "NO EXIF")
 
-    ### Create folders ###
+    @staticmethod
+    def duplicates_folder_path(source_folder):
+        return os.path.join(source_folder, "Duplicates")
 
     @staticmethod
-    def create_date_folder(source_folder, date_taken, file):
+    def create_date_folder(source_folder, date_taken, file, stats=None):
         """Create a folder based on the EXIF date if valid."""
-        if ProgramUtils.validate_date(date_taken):
+        destination_folder = ProgramUtils.date_folder_path(source_folder, date_taken)
+        if destination_folder:
             try:
-                year, month = date_taken.split("-")[:2]
-                destination_folder = os.path.join(source_folder, f"{year}-{month}")
                 if not os.path.exists(destination_folder):
                     os.makedirs(destination_folder)
-                    time.sleep(1)
-                    print(f"Created folder: {destination_folder}")
-                    ProgramUtils.folders_created += 1
-                    ProgramUtils.folders_created_flag_value = True
+                    log.info("Created folder: %s", destination_folder)
+                    if stats is not None:
+                        stats.add("folders_created")
                 dest_path = os.path.join(destination_folder, file)
                 return dest_path
-            except exception as e:
-                print(f"Unable to create folder based on Year and Month: {e}")
+            except OSError as e:
+                log.warning("Unable to create folder based on Year and Month: %s", e)
         return None
 
     @staticmethod
@@ -195,32 +204,30 @@ class ProgramUtils:
             if 1950 <= year <= current_year and 1 <= month <= 12:
                 return True
             else:
-                print(f"Invalid date: {date_taken}")
+                log.debug("Invalid date: %s", date_taken)
                 return False
-        except exception as e:
-            print(f"Error validating date: {e}")
+        except Exception as e:
+            log.warning("Error validating date: %s", e)
             return False
 
     @staticmethod
-    def create_no_exif_folder(source_folder):
-        no_exif_folder = os.path.join(source_folder, "NO EXIF")
+    def create_no_exif_folder(source_folder, stats=None):
+        no_exif_folder = ProgramUtils.no_exif_folder_path(source_folder)
         if not os.path.exists(no_exif_folder):
             os.makedirs(no_exif_folder)
-            time.sleep(1)
-            print(f"Created 'NO EXIF' folder at {no_exif_folder}")
-            ProgramUtils.folders_created += 1
-            ProgramUtils.folders_created_flag_value = True
+            log.info("Created 'NO EXIF' folder at %s", no_exif_folder)
+            if stats is not None:
+                stats.add("folders_created")
         return no_exif_folder
 
     @staticmethod
-    def create_duplicates_folder(source_folder):
-        duplicates_folder = os.path.join(source_folder, "Duplicates")
+    def create_duplicates_folder(source_folder, stats=None):
+        duplicates_folder = ProgramUtils.duplicates_folder_path(source_folder)
         if not os.path.exists(duplicates_folder):
             os.makedirs(duplicates_folder)
-            time.sleep(1)
-            print(f"Created 'duplicates' folder at {duplicates_folder}")
-            ProgramUtils.folders_created += 1
-            ProgramUtils.folders_created_flag_value = True
+            log.info("Created 'duplicates' folder at %s", duplicates_folder)
+            if stats is not None:
+                stats.add("folders_created")
         return duplicates_folder
 
 
@@ -1,7 +1,41 @@
+import calendar
 import re
 
+from program_utils import ProgramUtils
+
+YEAR = r'(?:19[5-9][0-9]|20[0-9]{2})'
+MONTH = r'(?:0[1-9]|1[0-2])'
+DAY = r'(?:0[1-9]|[12][0-9]|3[01])'
+
 
 class RegexUtils:
+    date_patterns = [
+        re.compile(r'(?<![\d])((20[0-9]{2})[-]?(0[1-9]|1[0-2])[-]?(0[1-9]|[12][0-9]|3[01]))(?![\d])'),
+        re.compile(r'(?<![\d])((0[1-9]|[12][0-9]|3[01])[-]?(0[1-9]|1[0-2])[-]?(20[0-9]{2}))(?![\d])'),
+        re.compile(r'(?<![\d])((20[0-9]{2})[-]?(0[1-9]|1[0-2]))(?![\d])'),
+        re.compile(r'(?<![\d])((0[1-9]|1[0-2])[-]?(20[0-9]{2}))(?![\d])'),
+    ]
+
+    # The same four layouts in one pattern, the alternatives in the order of date_patterns:
+    # the first date in the name wins, a full date over a year-month at the same position.
+    # match.lastindex (the last group of the alternative) tells which one matched.
+    # The lookahead skips positions that can't start a date.
+    date_pattern = re.compile(
+        rf'(?<![\d])(?=[0-3]|19)(?:'
+        rf'({YEAR})-?({MONTH})-?({DAY})'
+        rf'|({DAY})-?({MONTH})-?({YEAR})'
+        rf'|({YEAR})-?({MONTH})'
+        rf'|({MONTH})-?({YEAR})'
+        rf')(?![\d])'
+    )
+    # lastindex -> (year group, month group, day group or 0)
+    date_layouts = {
+        3: (1, 2, 3),
+        6: (6, 5, 4),
+        8: (7, 8, 0),
+        10: (10, 9, 0),
+    }
+
     @staticmethod
     def correct_file(file):
         """
@@ -14,22 +48,51 @@ class RegexUtils:
     def regex_date_filter(file):
         """
         Extract date from the filename using regex.
+        Returns the raw matched text, see extract_date for a parsed (year, month, day).
         """
-        # Add your regex patterns here
-        date_patterns = [
-            r'(?<![\d])((20[0-9]{2})[-]?(0[1-9]|1[0-2])[-]?(0[1-9]|[12][0-9]|3[01]))(?![\d])',
-            r'(?<![\d])((0[1-9]|[12][0-9]|3[01])[-]?(0[1-9]|1[0-2])[-]?(20[0-9]{2}))(?![\d])',
-            r'(?<![\d])((20[0-9]{2})[-]?(0[1-9]|1[0-2]))(?![\d])',
-            r'(?<![\d])((0[1-9]|1[0-2])[-]?(20[0-9]{2}))(?![\d])',
-        ]
-        for pattern in date_patterns:
-            match = re.search(pattern, file)
+        for pattern in RegexUtils.date_patterns:
+            match = pattern.search(file)
             if match:
                 return match.group()
         return None
 
+    @staticmethod
+    def extract_date(file, parsed=None):
+        """
+        Extract (year, month, day) from the filename in a single scan, day is None for year-month names.
+        Dates that ProgramUtils.validate_date rejects and days the month doesn't have are skipped.
+        parsed: {matched text: date or None} shared by a batch, so each date text is parsed once
+        """
+        if parsed is None:
+            parsed = {}
+        search = RegexUtils.date_pattern.search
+        match = search(file)
+        while match is not None:
+            text = match.group()
+            date = parsed.get(text, False)
+            if date is False:
+                year_group, month_group, day_group = RegexUtils.date_layouts[match.lastindex]
+                year, month = match.group(year_group, month_group)
+                day = int(match.group(day_group)) if day_group else None
+                date = None
+                if ProgramUtils.validate_date(f"{year}-{month}") and (
+                        day is None or day <= calendar.monthrange(int(year), int(month))[1]):
+                    date = int(year), int(month), day
+                parsed[text] = date
+            if date is not None:
+                return date
+            # Go on after this match, never back into it
+            match = search(file, match.end())
+        return None
+
+    @staticmethod
+    def extract_dates(files):
+        """Return extract_date for every name in an iterable, in the same order."""
+        parsed = {}
+        return [RegexUtils.extract_date(file, parsed) for file in files]
+
 
 
 # Example usage:
 # corrected_name = RegexUtils.correct_file("example[123].jpg")
-# extracted_date = RegexUtils.extract_date_from_filename("2022-12-25_example.jpg")
+# extracted_date = RegexUtils.extract_date("2022-12-25_example.jpg")  # (2022, 12, 25)
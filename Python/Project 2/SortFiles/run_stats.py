@@ -0,0 +1,251 @@
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from instrumentation import NO_SPAN
+
+"""
+This file is used for:
+- Counting what one run did (one RunStats object per run)
+- Timing the stages of a run: scan, exif, hash, move
+
+- Live progress of the current stage, polled by the GUI
+- Handing out timing spans when a Tracer is attached (see instrumentation.py)
+
+Counters are guarded by a lock so worker threads can share one object.
+Worker processes work on their own RunStats and the parent merges
+their snapshot() back in with merge().
+"""
+
+
+class RunCancelled(Exception):
+    """Raised between files when the run's cancel event is set."""
+
+
+class RunStats:
+    counter_names = [
+        "files_found",
+        "total_files_processed",
+        "moved_files",
+        "no_exif_files",
+        "duplicates",
+        "folders_created",
+        "linked_files",
+        "bytes_reclaimed",
+        "spilled_files",
+        "bytes_read",
+        "total_bytes",
+    ]
+
+    def __init__(self, action=""):
+        self.action = action
+        self.message = ""
+        # Why the run stopped early, empty when it completed or was cancelled
+        self.error = ""
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(RunStats.counter_names, 0)
+        self.stage_times = {}
+        self.started = time.perf_counter()
+        self.elapsed = None
+        self.current_stage = ""
+        self.stage_done = 0
+        self.stage_total = None
+        self.stage_started = self.started
+        self.tracer = None
+        # ru_maxrss never goes down: only a peak above this one was reached during the run
+        self.peak_before = RunStats.peak_memory()
+        self.span_summary = {}
+        self.profile_report = ""
+
+    def __getstate__(self):
+        # Locks can't be pickled, a copy in another process gets its own (and no tracer)
+        state = self.__dict__.copy()
+        del state["lock"]
+        state["tracer"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        counters = self.__dict__.get("counters")
+        if counters is not None and name in counters:
+            return counters[name]
+        raise AttributeError(name)
+
+    def __str__(self):
+        if self.message:
+            return f"{self.message}\n\n{self.report()}"
+        return self.report()
+
+    ### Counting ###
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.stage_times[stage] = self.stage_times.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name, total=None):
+        """Time a block of work as one stage, repeated stages add up."""
+        self.set_stage(name, total)
+        start = time.perf_counter()
+        try:
+            with self.span(name, "stage"):
+                yield self
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def span(self, name, category="file", **args):
+        """A timing span for the trace, a shared no-op when no Tracer is attached."""
+        if self.tracer is None:
+            return NO_SPAN
+        return self.tracer.span(name, category, **args)
+
+    def timed_iter(self, name, iterable):
+        """
+        Yield from iterable and count the time spent waiting on it as stage name,
+        with a Tracer every wait is a span of its own.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                with self.span(name):
+                    item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.perf_counter() - start)
+                return
+            self.add_time(name, time.perf_counter() - start)
+            yield item
+
+    ### Progress ###
+
+    def set_stage(self, name, total=None):
+        """Make name the current stage, total is the amount of files it will handle when known."""
+        with self.lock:
+            self.current_stage = name
+            self.stage_done = 0
+            self.stage_total = total
+            self.stage_started = time.perf_counter()
+
+    def set_stage_total(self, total):
+        with self.lock:
+            self.stage_total = total
+
+    def advance(self, amount=1):
+        with self.lock:
+            self.stage_done += amount
+
+    def progress(self):
+        """Return (stage, done, total, files_per_second, eta_seconds), total and eta may be None."""
+        with self.lock:
+            seconds = time.perf_counter() - self.stage_started
+            rate = self.rate(self.stage_done, seconds)
+            eta = None
+            if self.stage_total is not None and rate > 0:
+                eta = max(0, self.stage_total - self.stage_done) / rate
+            return self.current_stage, self.stage_done, self.stage_total, rate, eta
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+        if self.tracer is not None:
+            # Once per run, snapshot() is polled while the run goes on
+            self.span_summary = self.tracer.summary()
+        return self
+
+    ### Combining ###
+
+    def snapshot(self):
+        """A plain dict copy, safe to send between processes or dump as JSON."""
+        with self.lock:
+            elapsed = self.elapsed if self.elapsed is not None else time.perf_counter() - self.started
+            return {
+                "action": self.action,
+                "error": self.error,
+                "counters": dict(self.counters),
+                "stage_times": dict(self.stage_times),
+                "elapsed": elapsed,
+                "files_per_second": self.rate(self.counters["files_found"], elapsed),
+                "bytes_per_second": self.rate(self.counters["bytes_read"], elapsed),
+                "spans": self.span_summary,
+                "profile": self.profile_report,
+                "process_peak_rss": self.peak_memory(),
+                "peak_before_run": self.peak_before,
+            }
+
+    def merge(self, other):
+        """Add the counters and stage times of another RunStats or snapshot."""
+        if isinstance(other, RunStats):
+            other = other.snapshot()
+        with self.lock:
+            for name, amount in other["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+            for stage, seconds in other["stage_times"].items():
+                self.stage_times[stage] = self.stage_times.get(stage, 0.0) + seconds
+
+    ### Reporting ###
+
+    @staticmethod
+    def peak_memory():
+        """
+        Peak resident set size in bytes of this process over its whole lifetime, None if unknown.
+        Worker processes are not included, use --profile memory for the traced peak of one run.
+        """
+        try:
+            import resource
+        except ImportError:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KiB, macOS bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    @staticmethod
+    def rate(amount, seconds):
+        return amount / seconds if seconds > 0 else 0.0
+
+    def report(self):
+        snapshot = self.snapshot()
+        counters = snapshot["counters"]
+        file_status = ""
+
+        file_status += f"total files found: {counters['files_found']}\n"
+        file_status += f"Total files processed: {counters['total_files_processed']}\n"
+        if counters["duplicates"]:
+            # A link run replaces duplicates in place, nothing is moved
+            if not counters["linked_files"]:
+                file_status += f"Files moved to Duplicates folder: {counters['moved_files']}\n"
+            file_status += f"Duplicate files found: {counters['duplicates']}\n"
+        if counters["linked_files"]:
+            file_status += f"Duplicates replaced by links: {counters['linked_files']}\n"
+            file_status += f"Bytes reclaimed: {counters['bytes_reclaimed']}\n"
+        if counters["total_bytes"]:
+            percentage = counters["bytes_read"] / counters["total_bytes"] * 100
+            file_status += (f"Bytes read: {counters['bytes_read']} of {counters['total_bytes']} "
+                            f"({percentage:.1f}%)\n")
+        if counters["no_exif_files"]:
+            file_status += f"Files moved to 'NO EXIF'  folder: {counters['no_exif_files']}\n"
+        if counters["folders_created"]:
+            file_status += f"Folders created: {counters['folders_created']}\n"
+        if counters["spilled_files"]:
+            file_status += f"Files spilled to disk: {counters['spilled_files']}\n"
+        for stage, seconds in snapshot["stage_times"].items():
+            file_status += f"Stage {stage}: {seconds:.3f}s\n"
+        file_status += (f"Elapsed: {snapshot['elapsed']:.3f}s "
+                        f"({snapshot['files_per_second']:.1f} files/s)\n")
+        if snapshot["process_peak_rss"] is not None:
+            file_status += f"Process peak RSS: {snapshot['process_peak_rss'] / 2 ** 20:.1f} MiB"
+            if snapshot["process_peak_rss"] <= snapshot["peak_before_run"]:
+                # An earlier run in this process (e.g. in the GUI) went higher, this run's own peak is lower
+                file_status += " (reached before this run)"
+            file_status += "\n"
+        if self.tracer is not None:
+            file_status += f"{self.tracer.report()}\n"
+        if self.profile_report:
+            file_status += f"{self.profile_report}\n"
+        return file_status
@@ -0,0 +1,244 @@
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+from exif_reader import ExifReader
+from instrumentation import log
+from run_stats import RunCancelled, RunStats
+
+"""
+This file is used for:
+- Finding near-duplicate photos: resized, recompressed or re-exported copies
+
+Stages:
+1. A dHash per image: a 9x8 grayscale thumbnail, one bit per horizontal
+   gradient, 64 bits in total. Computed in worker processes, cached in the index.
+2. Clustering in a BK-tree on Hamming distance, so every image is only compared
+   with the few clusters that can be within the threshold instead of all images.
+
+Within a cluster the largest file is kept as the original, the rest go to
+the same 'Duplicates' folder as exact duplicates.
+"""
+
+
+class BKTree:
+    """A Burkhard-Keller tree of 64-bit hashes under Hamming distance."""
+
+    def __init__(self):
+        self.root = None
+
+    @staticmethod
+    def distance(first, second):
+        return bin(first ^ second).count("1")
+
+    def add(self, hash_value, item):
+        """Add item under hash_value, nodes are [hash_value, item, {distance: child}]."""
+        node = [hash_value, item, {}]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = BKTree.distance(hash_value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, hash_value, max_distance):
+        """Return [(distance, item)] within max_distance, nearest first."""
+        found = []
+        if self.root is None:
+            return found
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = BKTree.distance(hash_value, node[0])
+            if distance <= max_distance:
+                found.append((distance, node[1]))
+            # Triangle inequality: only children at distance +- max_distance can match
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        found.sort(key=lambda match: match[0])
+        return found
+
+
+class SimilarFinder:
+    hash_size = 8
+    batch_size = 32
+    default_threshold = 6
+
+    def __init__(self, index=None, workers=1, run_stats=None, cancel_event=None, threshold=None):
+        self.index = index
+        self.workers = max(1, workers)
+        self.run_stats = run_stats if run_stats is not None else RunStats("find-similar")
+        self.cancel_event = cancel_event
+        self.threshold = SimilarFinder.default_threshold if threshold is None else threshold
+        self.file_stats = {}
+        self.order = {}
+
+    def find_similar(self, files):
+        """
+        Return a list of (original, duplicate, distance) for every near-duplicate.
+        files can be paths or os.DirEntry objects.
+        """
+        similar = []
+        for group in self.group_similar(files):
+            original = group[0][1]
+            for distance, duplicate in group[1:]:
+                similar.append((original, duplicate, distance))
+        return similar
+
+    def group_similar(self, files):
+        """Return clusters of [(distance to the original, file_name)], the original first."""
+        self.file_stats = {}
+        self.order = {}
+        with self.run_stats.stage("scan"):
+            images = self.collect_images(files)
+        with self.run_stats.stage("phash", len(images)):
+            hashes = self.perceptual_hashes(images)
+        with self.run_stats.stage("cluster", len(hashes)):
+            clusters = self.cluster(images, hashes)
+
+        groups = []
+        for cluster in clusters:
+            if len(cluster) < 2:
+                continue
+            # The largest file is most likely the one the others were made from
+            original = max(cluster, key=lambda file_name: (self.file_stats[file_name].st_size,
+                                                           -self.order[file_name]))
+            hash_value = hashes[original]
+            group = [(0, original)]
+            for file_name in sorted(cluster, key=self.order.get):
+                if file_name != original:
+                    group.append((BKTree.distance(hash_value, hashes[file_name]), file_name))
+            groups.append(group)
+        groups.sort(key=lambda group: min(self.order[file_name] for _, file_name in group))
+        return groups
+
+    def collect_images(self, files):
+        """Stage 1a: the files that can be images, in input order."""
+        images = []
+        for file in files:
+            self.check_cancelled()
+            file_name = file.path if isinstance(file, os.DirEntry) else file
+            extension = os.path.splitext(file_name)[1].lower()
+            if file_name in self.file_stats or extension in ExifReader.non_image_extensions:
+                continue
+            try:
+                stat = file.stat() if isinstance(file, os.DirEntry) else os.stat(file_name)
+            except OSError as e:
+                log.warning("Error reading size for %s: %s", file_name, e)
+                continue
+            self.file_stats[file_name] = stat
+            self.order[file_name] = len(self.order)
+            self.run_stats.add("files_found")
+            self.run_stats.advance()
+            images.append(file_name)
+        return images
+
+    def perceptual_hashes(self, images):
+        """Stage 1b: {file_name: dhash} from the index or from worker processes."""
+        kind = f"dhash:{self.hash_size}"
+        hashes = {}
+        missing = []
+        for file_name in images:
+            cached = self.cached_hash(file_name, kind)
+            if cached is not None:
+                hashes[file_name] = int(cached, 16)
+                self.run_stats.advance()
+            else:
+                missing.append(file_name)
+
+        batches = [missing[start:start + self.batch_size]
+                   for start in range(0, len(missing), self.batch_size)]
+        executor = None
+        if self.workers > 1 and len(batches) > 1:
+            executor = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            if executor is None:
+                results = (SimilarFinder.calculate_dhashes(batch, self.hash_size) for batch in batches)
+            else:
+                results = executor.map(SimilarFinder.calculate_dhashes, batches,
+                                       [self.hash_size] * len(batches))
+            for batch, batch_hashes in zip(batches, results):
+                self.check_cancelled()
+                self.run_stats.advance(len(batch))
+                for file_name, hash_value in zip(batch, batch_hashes):
+                    if hash_value is None:
+                        continue
+                    hashes[file_name] = hash_value
+                    self.store_hash(file_name, kind, f"{hash_value:016x}")
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        return hashes
+
+    def cluster(self, images, hashes):
+        """Stage 2: greedy clustering, each image joins the nearest cluster within the threshold."""
+        tree = BKTree()
+        clusters = []
+        for file_name in images:
+            self.check_cancelled()
+            hash_value = hashes.get(file_name)
+            if hash_value is None:
+                continue
+            self.run_stats.advance()
+            matches = tree.search(hash_value, self.threshold)
+            if matches:
+                clusters[matches[0][1]].append(file_name)
+            else:
+                # The first image of a cluster is its representative in the tree
+                tree.add(hash_value, len(clusters))
+                clusters.append([file_name])
+        return clusters
+
+    def cached_hash(self, file_name, kind):
+        if self.index is None:
+            return None
+        try:
+            return self.index.get_hash(file_name, kind, self.file_stats.get(file_name))
+        except (OSError, sqlite3.Error) as e:
+            log.warning("Error using index for %s: %s", file_name, e)
+            return None
+
+    def store_hash(self, file_name, kind, value):
+        if self.index is None:
+            return
+        try:
+            self.index.set_hash(file_name, kind, value, self.file_stats.get(file_name))
+        except (OSError, sqlite3.Error) as e:
+            log.warning("Error using index for %s: %s", file_name, e)
+
+    def check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise RunCancelled("Similar photo search cancelled")
+
+    @staticmethod
+    def calculate_dhashes(file_names, hash_size=8):
+        """dHash of a batch of files, one worker task per batch."""
+        return [SimilarFinder.calculate_dhash(file_name, hash_size) for file_name in file_names]
+
+    @staticmethod
+    def calculate_dhash(file_name, hash_size=8):
+        """Return the dHash of an image as an int, None when it can't be decoded."""
+        try:
+            from PIL import Image, ImageOps
+            with Image.open(file_name) as image:
+                # Let the JPEG decoder scale down while decoding, much cheaper than a full decode
+                image.draft("L", (hash_size * 8, hash_size * 8))
+                image = ImageOps.exif_transpose(image)
+                thumbnail = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+        except Exception as e:
+            log.warning("Error calculating perceptual hash for %s: %s", file_name, e)
+            return None
+
+        pixels = list(thumbnail.getdata())
+        hash_value = 0
+        for row in range(hash_size):
+            offset = row * (hash_size + 1)
+            for column in range(hash_size):
+                hash_value = (hash_value << 1) | (pixels[offset + column] < pixels[offset + column + 1])
+        return hash_value
@@ -0,0 +1,64 @@
+import argparse
+import time
+import tracemalloc
+from collections import deque
+
+from chunk_list import chunk, chunk_view, ichunk
+from flatten_list import deep_flatten, flatten, flatten_view, iflatten
+
+
+def consume(iterable):
+    """run an iterator to the end without keeping its items"""
+    deque(iterable, maxlen=0)
+
+
+def measure(name, work):
+    """print the time of one run and the peak memory of a second, traced run"""
+    start = time.perf_counter()
+    work()
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    work()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{name:<42} {seconds:8.3f}s {peak / (1024 * 1024):10.2f} MiB peak")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time and memory of the list helpers")
+    parser.add_argument("--size", type=int, default=2_000_000)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+    size, chunk_size = args.size, args.chunk_size
+
+    numbers = list(range(size))
+    data = bytes(size * 8)
+    nested = [list(range(i, i + 10)) for i in range(0, size, 10)]
+
+    print(f"{size} items, chunks of {chunk_size}")
+    measure("chunk(list)", lambda: consume(chunk(numbers, chunk_size)))
+    measure("ichunk(list)", lambda: consume(ichunk(numbers, chunk_size)))
+    measure("ichunk(generator)", lambda: consume(ichunk(iter(range(size)), chunk_size)))
+    measure("chunk(bytes)", lambda: consume(chunk(data, chunk_size * 8)))
+    measure("chunk_view(bytes)", lambda: consume(chunk_view(data, chunk_size * 8)))
+
+    measure("sum(flatten(nested))", lambda: sum(flatten(nested)))
+    measure("sum(iflatten(nested))", lambda: sum(iflatten(nested)))
+    measure("sum(deep_flatten(nested))", lambda: sum(deep_flatten(nested)))
+
+    try:
+        import numpy
+    except ImportError:
+        print("numpy not installed, skipping the array variants")
+        return
+    array = numpy.arange(size, dtype=numpy.int64)
+    matrix = array.reshape(-1, 10)
+    measure("chunk(ndarray.tolist())", lambda: consume(chunk(array.tolist(), chunk_size)))
+    measure("chunk_view(ndarray)", lambda: consume(chunk_view(array, chunk_size)))
+    measure("flatten(ndarray.tolist())", lambda: flatten(matrix.tolist()))
+    measure("flatten_view(ndarray)", lambda: flatten_view(matrix))
+
+
+if __name__ == "__main__":
+    main()
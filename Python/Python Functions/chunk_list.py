@@ -1,3 +1,25 @@
+from itertools import islice
+
+
 def chunk(totallist, size):
     for i in range(0, len(totallist), size):
-        yield totallist[i:i + size]
\ No newline at end of file
+        yield totallist[i:i + size]
+
+
+def ichunk(iterable, size):
+    """chunk any iterable, also generators and files. yields lists, the last one may be shorter"""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def chunk_view(buffer, size):
+    """
+    zero-copy chunks of a buffer (bytes, bytearray, array.array, mmap) or a NumPy array.
+    yields memoryview slices, or NumPy views for an array. nothing is copied.
+    """
+    if not hasattr(buffer, "__array_interface__"):
+        # slicing a memoryview shares the memory of the buffer
+        buffer = memoryview(buffer)
+    for i in range(0, len(buffer), size):
+        yield buffer[i:i + size]
@@ -1,3 +1,52 @@
+from collections.abc import Iterable
+from itertools import chain
+
+
 def flatten(nestedlist):
     """flatten a nested list. returns one full list"""
-    return [item for sublist in nestedlist for item in sublist]
\ No newline at end of file
+    return [item for sublist in nestedlist for item in sublist]
+
+
+def iflatten(nestedlist):
+    """flatten one level lazily. returns an iterator, no list is built"""
+    return chain.from_iterable(nestedlist)
+
+
+def flatten_view(array):
+    """
+    flatten a buffer or NumPy array without copying.
+    returns a 1-D memoryview, or a 1-D NumPy view. both are a copy only when the data isn't contiguous
+    """
+    if hasattr(array, "__array_interface__"):
+        return array.reshape(-1)
+    view = memoryview(array)
+    if view.ndim == 1:
+        return view
+    if not view.contiguous:
+        # cast only works on contiguous memory, tobytes() copies it in C order
+        return memoryview(view.tobytes()).cast(view.format)
+    # memoryview can only reshape through bytes
+    return view.cast("B").cast(view.format)
+
+
+def deep_flatten(nested, keep=(str, bytes, bytearray, dict)):
+    """
+    flatten data of any depth lazily. works with an explicit stack, so deep nesting
+    can't hit the recursion limit. items of a type in keep are not taken apart.
+    """
+    # the isinstance checks against the Iterable ABC are slow, decide once per type
+    is_nested = {}
+    stack = [iter(nested)]
+    while stack:
+        for item in stack[-1]:
+            item_type = type(item)
+            nested_type = is_nested.get(item_type)
+            if nested_type is None:
+                nested_type = issubclass(item_type, Iterable) and not issubclass(item_type, keep)
+                is_nested[item_type] = nested_type
+            if nested_type:
+                stack.append(iter(item))
+                break
+            yield item
+        else:
+            stack.pop()
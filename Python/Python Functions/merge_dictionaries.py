@@ -1,19 +1,97 @@
-import copy
+LIST_POLICIES = ("replace", "extend", "unique")
+SET_POLICIES = ("replace", "union")
 
-def merge_dictionaries(diction1, diction2):
+
+def merge_dictionaries(diction1, diction2, lists="replace", sets="replace"):
+    """
+    Merge diction2 into diction1 and return diction1 (diction1 is changed).
+    Works with an explicit stack instead of recursion, so any depth is fine.
+    lists: "replace" (default), "extend" or "unique" (extend, skip items already there)
+    sets: "replace" (default) or "union"
+    """
+    return _merge(diction1, diction2, None, lists, sets)
+
+
+def merge_dictionaries_no_mutation(diction1, diction2, lists="replace", sets="replace"):
+    """
+    Same result as merge_dictionaries, diction1 stays untouched.
+    Only the dicts on the paths diction2 changes are copied, all other subtrees
+    are shared with diction1 (and values from diction2 are shared with diction2),
+    so copy.deepcopy the result before changing it in place.
+    """
+    owned = {}
+    return _merge(_own(dict(diction1), owned), diction2, owned, lists, sets)
+
+
+def merge_many(dictionaries, lists="replace", sets="replace"):
     """
-    This function works RECURSIVELY.
-    Therefore, it can handle more depth than flatten_list can.
+    Fold any number of dicts (also a generator) into one new dict, from left to right.
+    None of the inputs is changed and every path is copied at most once over the whole fold.
     """
-    for key, value in diction2.items():
-        if key in diction1 and isinstance(diction1[key], dict) and isinstance(value, dict):
-            merge_dictionaries(diction1[key], value)
-        else:
-            diction1[key] = value
-    return diction1
+    owned = {}
+    result = _own({}, owned)
+    for diction in dictionaries:
+        _merge(result, diction, owned, lists, sets)
+    return result
+
+
+def _own(value, owned):
+    """remember a container this merge made itself, it may be changed in place later on"""
+    # keep a reference, so the id can't be reused by another object
+    owned[id(value)] = value
+    return value
+
+
+def _merge(target, source, owned, lists, sets):
+    """merge source into target, owned=None changes everything in place"""
+    if lists not in LIST_POLICIES:
+        raise ValueError(f"lists must be one of {LIST_POLICIES}, not {lists!r}")
+    if sets not in SET_POLICIES:
+        raise ValueError(f"sets must be one of {SET_POLICIES}, not {sets!r}")
+
+    root = target
+    stack = [(target, source)]
+    while stack:
+        target, source = stack.pop()
+        for key, value in source.items():
+            current = target.get(key)
+            in_place = owned is None or id(current) in owned
 
+            if isinstance(current, dict) and isinstance(value, dict):
+                if not in_place:
+                    # copy this level only, its untouched children stay shared
+                    current = target[key] = _own(dict(current), owned)
+                stack.append((current, value))
+            elif lists != "replace" and isinstance(current, list) and isinstance(value, list):
+                if not in_place:
+                    current = target[key] = _own(list(current), owned)
+                if lists == "extend":
+                    current.extend(value)
+                else:
+                    _extend_unique(current, value)
+            elif (sets == "union" and isinstance(current, (set, frozenset))
+                  and isinstance(value, (set, frozenset))):
+                if in_place and isinstance(current, set):
+                    current |= value
+                else:
+                    target[key] = current | value
+                    if owned is not None and isinstance(target[key], set):
+                        _own(target[key], owned)
+            else:
+                target[key] = value
+    return root
 
-def merge_dictionaries_no_mutation(diction1, diction2):
-    diction1_copy = copy.deepcopy(diction1)
-    return merge_dictionaries(diction1_copy, diction2)
 
+def _extend_unique(current, items):
+    """append the items that aren't in current yet, hashed when possible"""
+    try:
+        seen = set(current)
+        for item in items:
+            if item not in seen:
+                seen.add(item)
+                current.append(item)
+    except TypeError:
+        # unhashable items: compare one by one
+        for item in items:
+            if item not in current:
+                current.append(item)
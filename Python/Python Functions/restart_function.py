@@ -1,12 +1,238 @@
+import asyncio
+import functools
+import random
+import threading
 import time
 
+
 def restart_function(failedfunction, tries=5, delay=1):
     """Try to restart the function after exception is thrown."""
-    for attempt in range(tries):
+    if tries < 1:
+        # like the original loop, no tries means no call
+        return None
+    return retry_call(failedfunction, tries=tries, delay=delay, backoff=1, jitter=None)
+
+
+class RetryStats:
+    """counters of all retried calls, safe to share between threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {
+            "calls": 0,            # retry_call invocations
+            "attempts": 0,         # times the function actually ran
+            "retries": 0,          # attempts after the first
+            "successes": 0,
+            "failures": 0,         # calls that gave up and raised
+            "rejected": 0,         # calls refused by an open circuit breaker
+            "failed_seconds": 0.0,  # time spent in attempts that raised
+            "sleep_seconds": 0.0,   # time spent waiting between attempts
+        }
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+# the counters used when no RetryStats is passed
+retry_stats = RetryStats()
+
+
+class CircuitOpenError(Exception):
+    """raised without calling the function while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """
+    stop calling a function that keeps failing.
+    after failure_threshold failed calls in a row the circuit opens and calls fail
+    fast with CircuitOpenError. after reset_timeout seconds one trial call is let
+    through: success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self):
+        with self.lock:
+            state = self.state
+            if state == "open" or (state == "half-open" and self.trial_running):
+                raise CircuitOpenError(f"circuit open after {self.failures} failures")
+            if state == "half-open":
+                self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    def record_ignored(self):
+        """an error that says nothing about the health of the call (not in retry_on): only end a trial"""
+        with self.lock:
+            self.trial_running = False
+
+
+def backoff_delays(delay=1, backoff=2.0, max_delay=60.0, jitter="full", rng=random):
+    """
+    endless waits between attempts: delay, delay*backoff, delay*backoff**2 ... capped at max_delay.
+    jitter spreads callers that fail together so they don't retry in lockstep:
+    "full" waits random(0, wait), "equal" waits wait/2 + random(0, wait/2), None waits exactly.
+    """
+    wait = delay
+    while True:
+        if jitter == "full":
+            yield rng.uniform(0, wait)
+        elif jitter == "equal":
+            yield wait / 2 + rng.uniform(0, wait / 2)
+        else:
+            yield wait
+        wait = min(max_delay, wait * backoff)
+
+
+def _should_retry(error, retry_on):
+    """retry_on is an exception type, a tuple of types or a function(error) -> bool"""
+    if isinstance(retry_on, (type, tuple)):
+        return isinstance(error, retry_on)
+    return retry_on(error)
+
+
+class _Attempts:
+    """the bookkeeping shared by the sync and async retry loops"""
+
+    def __init__(self, tries, delay, backoff, max_delay, jitter, retry_on, deadline, breaker, stats):
+        self.tries = tries
+        self.retry_on = retry_on
+        self.deadline = None if deadline is None else time.monotonic() + deadline
+        self.breaker = breaker
+        self.stats = stats if stats is not None else retry_stats
+        self.delays = backoff_delays(delay, backoff, max_delay, jitter)
+        self.attempt = 0
+        self.started = None
+        self.stats.add("calls")
+
+    def before(self):
+        if self.breaker is not None:
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                self.stats.add("rejected")
+                raise
+        self.attempt += 1
+        self.stats.add("attempts")
+        if self.attempt > 1:
+            self.stats.add("retries")
+        self.started = time.monotonic()
+
+    def succeeded(self):
+        self.stats.add("successes")
+        if self.breaker is not None:
+            self.breaker.record_success()
+
+    def failed(self, error):
+        """return the time to wait before the next attempt, or None to give up and raise error"""
+        self.stats.add("failed_seconds", time.monotonic() - self.started)
+        retryable = _should_retry(error, self.retry_on)
+        circuit_open = False
+        if self.breaker is not None:
+            if retryable:
+                self.breaker.record_failure()
+                # the next attempt would only be rejected, raise the real error now
+                circuit_open = self.breaker.state == "open"
+            else:
+                self.breaker.record_ignored()
+        wait = next(self.delays)
+        out_of_time = self.deadline is not None and time.monotonic() + wait > self.deadline
+        if self.attempt >= self.tries or out_of_time or not retryable or circuit_open:
+            self.stats.add("failures")
+            return None
+        self.stats.add("sleep_seconds", wait)
+        return wait
+
+
+def retry_call(function, args=(), kwargs=None, *, tries=5, delay=1, backoff=2.0, max_delay=60.0, jitter="full",
+               retry_on=Exception, deadline=None, breaker=None, stats=None):
+    """
+    call function(*args, **kwargs) until it succeeds, at most tries times.
+    the arguments of function are passed as args and kwargs, so they never mix with the retry options.
+    waits grow by backoff with jitter, deadline (seconds) bounds the whole call
+    including the waits, errors that don't match retry_on are raised immediately.
+    """
+    kwargs = kwargs or {}
+    attempts = _Attempts(tries, delay, backoff, max_delay, jitter, retry_on, deadline, breaker, stats)
+    while True:
+        attempts.before()
         try:
-            return failedfunction()
+            result = function(*args, **kwargs)
         except Exception as e:
-            if attempt < tries - 1:
-                time.sleep(delay)
-            else:
-                raise e
\ No newline at end of file
+            wait = attempts.failed(e)
+            if wait is None:
+                raise
+            time.sleep(wait)
+        else:
+            attempts.succeeded()
+            return result
+
+
+async def async_retry_call(function, args=(), kwargs=None, *, tries=5, delay=1, backoff=2.0, max_delay=60.0,
+                           jitter="full", retry_on=Exception, deadline=None, breaker=None, stats=None):
+    """retry_call for a coroutine function, waits with asyncio.sleep so the event loop keeps running"""
+    kwargs = kwargs or {}
+    attempts = _Attempts(tries, delay, backoff, max_delay, jitter, retry_on, deadline, breaker, stats)
+    while True:
+        attempts.before()
+        try:
+            result = await function(*args, **kwargs)
+        except Exception as e:
+            wait = attempts.failed(e)
+            if wait is None:
+                raise
+            await asyncio.sleep(wait)
+        else:
+            attempts.succeeded()
+            return result
+
+
+def retry(**options):
+    """
+    decorator form of retry_call / async_retry_call, takes the same keyword options.
+    the options are fixed here, every argument of a call goes to the function.
+        @retry(tries=3, retry_on=OSError, deadline=10)
+        def move(source, destination): ...
+    """
+    def decorate(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                return await async_retry_call(function, args, kwargs, **options)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return retry_call(function, args, kwargs, **options)
+        return wrapper
+    return decorate